@@ -0,0 +1,202 @@
+import time
+import logging
+import threading
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# GUIDESTAT while the guider is running, errors from any other state say nothing about tracking
+GUIDING = 2
+
+
+class RollingWindow(object):
+    """Fixed size ring of samples: a float64 timestamp and float32 columns.
+
+    append() is a couple of array stores, and columns() hands the rows back oldest first
+    so statistics run over the whole window as array operations.
+    """
+    def __init__(self, fields, size=4096):
+        self.fields = tuple(fields)
+        self.size = size
+        self._timestamps = np.zeros(size, dtype=np.float64)
+        self._values = np.zeros((size, len(self.fields)), dtype=np.float32)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, values):
+        row = self._next
+        self._timestamps[row] = timestamp
+        self._values[row] = values
+        self._next = (row + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def columns(self, since=None):
+        """(timestamps, {field: values}) in time order, only rows at or after since if given.
+        The arrays are copies, safe to use while more samples are appended.
+        """
+        if self._count < self.size:
+            timestamps, values = self._timestamps[:self._count].copy(), self._values[:self._count].copy()
+        else:
+            timestamps = np.roll(self._timestamps, -self._next)
+            values = np.roll(self._values, -self._next, axis=0)
+        if since is not None:
+            first = np.searchsorted(timestamps, since)
+            timestamps, values = timestamps[first:], values[first:]
+        return timestamps, {field: values[:, i] for i, field in enumerate(self.fields)}
+
+
+def _slope(timestamps, values):
+    """Least squares change of values per hour, NaN for fewer than three points"""
+    if len(values) < 3 or timestamps[-1] == timestamps[0]:
+        return float('nan')
+    hours = (timestamps - timestamps[0]) / 3600
+    return float(np.polyfit(hours, values.astype(np.float64), 1)[0])
+
+
+def _value(value, digits=3):
+    return None if value != value else round(float(value), digits)
+
+
+class QualityMonitor(object):
+    """Guiding and focus quality from the ControlData and NewJPGReady streams.
+
+    Guide errors (GUIDEX along RA, GUIDEY along Dec) taken while the guider runs go into
+    one rolling window, and the HFD and StarIndex of each frame into a window per target
+    and filter, so nothing is kept per message beyond a row in an array. guiding() and
+    focus() then work out RMS and trends over those windows with numpy.
+
+        monitor = QualityMonitor()
+        monitor.attach(client)
+        if monitor.guiding()['rms'] > 1.5 or monitor.focus('M31', 'L')['hfd_rise'] > 0.15:
+            ...
+    """
+    def __init__(self, guide_window=120, guide_samples=4096, frames=50):
+        self.guide_window = guide_window
+        self.frames = frames
+
+        self._guide = RollingWindow(('ra', 'dec'), guide_samples)
+        self._focus = {}
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def attach(self, client):
+        """Follow the events of a VoyagerClient on its handler pool. Guide errors queue up
+        while the monitor is busy, so none are skipped unless the queue overflows; of
+        NewJPGReady only the newest is kept.
+        """
+        self._handlers[client] = [
+            client.add_handler('ControlData', self.observe, queue_size=1000, overflow='drop_oldest'),
+            client.add_handler('NewJPGReady', self.observe, overflow='latest')
+        ]
+
+    def detach(self, client):
+        for handler in self._handlers.pop(client):
+            client.remove_handler(handler.handle, handler)
+
+    def observe(self, message):
+        event = message.get('Event')
+        timestamp = message.get('Timestamp')
+        if timestamp is None:
+            return
+        if event == 'ControlData':
+            self.add_guide_error(timestamp, message.get('GUIDEX'), message.get('GUIDEY'),
+                                 message.get('GUIDESTAT', GUIDING))
+        elif event == 'NewJPGReady':
+            self.add_frame(timestamp, message.get('SequenceTarget'), message.get('Filter'),
+                           message.get('HFD'), message.get('StarIndex'))
+
+    def add_guide_error(self, timestamp, ra, dec, status=GUIDING):
+        if status != GUIDING:
+            return
+        try:
+            errors = (float(ra), float(dec))
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._guide.append(timestamp, errors)
+
+    def add_frame(self, timestamp, target, filter_name, hfd, star_index):
+        try:
+            quality = (float(hfd), float(star_index))
+        except (TypeError, ValueError):
+            return
+        key = (target or '', filter_name or '')
+        with self._lock:
+            window = self._focus.get(key)
+            if window is None:
+                window = self._focus[key] = RollingWindow(('hfd', 'starindex'), self.frames)
+            window.append(timestamp, quality)
+
+    def guiding(self, window=None, now=None):
+        """RMS guide error along RA, Dec and in total over the last window seconds, with the
+        largest single error and the number of samples it is based on.
+
+        The window ends at now, by default the newest sample, so Voyager's clock is used.
+        """
+        window = window or self.guide_window
+        with self._lock:
+            timestamps, errors = self._guide.columns()
+        if now is None:
+            now = timestamps[-1] if len(timestamps) else time.time()
+        first = np.searchsorted(timestamps, now - window)
+        ra, dec = errors['ra'][first:].astype(np.float64), errors['dec'][first:].astype(np.float64)
+
+        if not len(ra):
+            return {'ra': None, 'dec': None, 'rms': None, 'peak': None, 'samples': 0}
+        squared = ra * ra + dec * dec
+        return {
+            'ra': _value(np.sqrt(np.mean(ra * ra))),
+            'dec': _value(np.sqrt(np.mean(dec * dec))),
+            'rms': _value(np.sqrt(np.mean(squared))),
+            'peak': _value(np.sqrt(squared.max())),
+            'samples': len(ra)
+        }
+
+    def focus(self, target, filter_name, recent=3):
+        """HFD and StarIndex trend of target through filter_name, or None before its first frame.
+
+        hfd_rise is how far the median HFD of the last recent frames sits above the best
+        median of recent frames in the window, e.g. 0.2 for 20% softer than it has been.
+        Slopes are per hour.
+        """
+        with self._lock:
+            window = self._focus.get((target or '', filter_name or ''))
+            if window is None or not len(window):
+                return None
+            timestamps, columns = window.columns()
+        hfd, star_index = columns['hfd'], columns['starindex']
+
+        recent = min(recent, len(hfd))
+        # Median of every run of recent frames, the lowest of them being the best focus seen
+        runs = np.lib.stride_tricks.sliding_window_view(hfd, recent)
+        medians = np.median(runs, axis=1)
+        best = medians.min()
+
+        return {
+            'target': target,
+            'filter': filter_name,
+            'frames': len(hfd),
+            'hfd': _value(hfd[-1]),
+            'hfd_mean': _value(hfd.mean()),
+            'hfd_best': _value(best),
+            'hfd_rise': _value(medians[-1] / best - 1 if best > 0 else float('nan')),
+            'hfd_slope': _value(_slope(timestamps, hfd)),
+            'starindex': _value(star_index[-1]),
+            'starindex_mean': _value(star_index.mean()),
+            'starindex_slope': _value(_slope(timestamps, star_index))
+        }
+
+    def groups(self):
+        """(target, filter) of every window with frames in it"""
+        with self._lock:
+            return list(self._focus)
+
+    def summary(self):
+        return {
+            'guiding': self.guiding(),
+            'focus': [self.focus(target, filter_name) for target, filter_name in self.groups()]
+        }
@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import base64
+import socket
+import struct
+import argparse
+import resource
+import threading
+import multiprocessing
+
+from fake_voyager import FakeVoyagerServer
+from voyager_api import VoyagerClient
+from ws_transport import decode_image_frame
+
+SCENARIOS = ('events', 'images', 'commands', 'bridge')
+
+
+def _serve(port_queue, rates, jpg_dims, command_delay):
+    server = FakeVoyagerServer(port=0, rates=rates, jpg_dims=jpg_dims, command_delay=command_delay)
+    port_queue.put(server.port)
+    server.serve_forever()
+
+
+class FakeVoyagerProcess(object):
+    """Runs a FakeVoyagerServer in a child process, so its CPU isn't billed to the client"""
+    def __init__(self, rates, jpg_dims=(2328, 1760), command_delay=0.0):
+        # Everything not asked for stays quiet, so the scenario measures one thing
+        self.rates = dict.fromkeys(('Polling', 'ControlData', 'ShotRunning', 'LogEvent', 'Signal', 'NewJPGReady'), 0)
+        self.rates.update(rates)
+        self.jpg_dims = jpg_dims
+        self.command_delay = command_delay
+        self.port = None
+        self._process = None
+
+    def __enter__(self):
+        port_queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_serve, daemon=True,
+                                                args=(port_queue, self.rates, self.jpg_dims, self.command_delay))
+        self._process.start()
+        self.port = port_queue.get(timeout=30)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._process.terminate()
+        self._process.join()
+
+
+class Usage(object):
+    """CPU time and peak memory of this process over a with block"""
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        self.peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def report(self):
+        return {
+            'cpu_seconds': round(self.cpu, 3),
+            'cpu_percent': round(100 * self.cpu / self.wall, 1),
+            'peak_rss_mb': round(self.peak_rss_mb, 1)
+        }
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def latency_report(latencies):
+    return {
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        'latency_max_ms': round(max(latencies) * 1000, 3) if latencies else None
+    }
+
+
+def _connect_client(port):
+    client = VoyagerClient('127.0.0.1', port)
+    client.start()
+    client.cmd.set_dashboard('enable')  # Returns once the session is up
+    return client
+
+
+def _measure_handler(port, event, duration):
+    latencies = []
+
+    def on_event(message):
+        latencies.append(time.time() - message['Timestamp'])
+
+    client = _connect_client(port)
+    client.add_handler(event, on_event, overflow='block', queue_size=10000)
+    with Usage() as usage:
+        time.sleep(duration)
+    received = client.metrics.events[event]
+    client.close()
+
+    results = {
+        'received_per_second': round(received / usage.wall, 1),
+        'handled_per_second': round(len(latencies) / usage.wall, 1),
+        'megabytes_in': round(client.metrics.bytes_in / 1e6, 1)
+    }
+    results.update(latency_report(latencies))
+    results.update(usage.report())
+    return results
+
+
+def bench_events(args):
+    """ControlData flood to a single handler"""
+    with FakeVoyagerProcess({'ControlData': args.rate, 'Polling': 0.2}) as server:
+        return _measure_handler(server.port, 'ControlData', args.duration)
+
+
+def bench_images(args):
+    """NewJPGReady frames of a full sensor JPEG"""
+    with FakeVoyagerProcess({'NewJPGReady': args.jpg_rate, 'Polling': 0.2}, tuple(args.jpg_dims)) as server:
+        return _measure_handler(server.port, 'NewJPGReady', args.duration)
+
+
+def bench_commands(args):
+    """send_command round trips, one at a time and from several threads at once"""
+    with FakeVoyagerProcess({'ControlData': 1, 'Polling': 0.2}) as server:
+        client = _connect_client(server.port)
+        # Every command has to make the round trip, not be answered from cache or ControlData
+        client.cmd.cache.ttls = {}
+
+        sequential = []
+        with Usage() as usage:
+            for _ in range(args.commands):
+                started = time.perf_counter()
+                client.cmd.get_ccd_temp()
+                sequential.append(time.perf_counter() - started)
+
+        concurrent = []
+        lock = threading.Lock()
+
+        def worker():
+            for _ in range(args.commands // args.threads):
+                started = time.perf_counter()
+                client.cmd.get_ccd_temp()
+                with lock:
+                    concurrent.append(time.perf_counter() - started)
+
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        wall = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - wall
+        client.close()
+
+    results = {
+        'rtt_p50_ms': round(percentile(sequential, 50) * 1000, 3),
+        'rtt_p99_ms': round(percentile(sequential, 99) * 1000, 3),
+        'sequential_per_second': round(len(sequential) / usage.wall, 1),
+        f"concurrent_{args.threads}_per_second": round(len(concurrent) / wall, 1),
+        'concurrent_rtt_p99_ms': round(percentile(concurrent, 99) * 1000, 3)
+    }
+    results.update(usage.report())
+    return results
+
+
+def _ws_connect(port, deflate=False):
+    sock = socket.create_connection(('127.0.0.1', port))
+    key = base64.b64encode(os.urandom(16)).decode()
+    extensions = "Sec-WebSocket-Extensions: permessage-deflate\r\n" if deflate else ""
+    sock.sendall(('GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                  f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n{extensions}\r\n").encode())
+    reader = sock.makefile('rb')
+    while reader.readline() not in (b'\r\n', b''):
+        pass
+    return sock, reader
+
+
+def _ws_read_frame(reader):
+    header = reader.read(2)
+    if len(header) < 2:
+        return None, None
+    opcode = header[0] & 0x0f
+    length = header[1] & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', reader.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', reader.read(8))[0]
+    return opcode, reader.read(length)
+
+
+def _ws_send(sock, message):
+    """Clients have to mask what they send"""
+    payload = json.dumps(message).encode()
+    mask = os.urandom(4)
+    header = struct.pack('>BB', 0x81, 0x80 | len(payload)) if len(payload) <= 125 else \
+        struct.pack('>BBH', 0x81, 0x80 | 126, len(payload))
+    sock.sendall(header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+
+
+def _ws_reader(port, duration, results, max_rate=0, deflate=False):
+    """Child process: one dashboard viewer counting what the bridge sends it"""
+    sock, reader = _ws_connect(port, deflate)
+    if max_rate:
+        _ws_send(sock, {'rate': max_rate})
+    sock.settimeout(duration)
+    frames = 0
+    received = 0
+    latencies = []
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            opcode, payload = _ws_read_frame(reader)
+        except socket.timeout:
+            break
+        if opcode is None:
+            break
+        frames += 1
+        received += len(payload)
+        if opcode == 0x2:
+            header, _ = decode_image_frame(payload)
+            if 'jpgshot' in header:
+                latencies.append(time.time() - header['jpgshot']['saved'])
+    sock.close()
+    results.put((frames, received, latencies))
+
+
+def bench_bridge(args):
+    """ws_server bridge fanning ControlData, ShotRunning and JPG frames out to viewers"""
+    try:
+        import ws_server
+    except ImportError as e:
+        return {'skipped': repr(e)}
+
+    rates = {'ControlData': args.bridge_rate, 'ShotRunning': args.bridge_rate,
+             'NewJPGReady': args.jpg_rate, 'Polling': 0.2}
+    with FakeVoyagerProcess(rates, tuple(args.jpg_dims)) as server:
+        if args.bridge_workers:
+            vclient, ws, workers, port = ws_server.start_fanout('127.0.0.1', server.port, ws_port=0,
+                                                                workers=args.bridge_workers,
+                                                                batch_window=args.batch_ms / 1000)
+            while ws.workers < len(workers):
+                time.sleep(0.1)
+        else:
+            vclient, ws = ws_server.start_bridge('127.0.0.1', server.port, ws_port=0,
+                                                 batch_window=args.batch_ms / 1000)
+            ws.run_forever(threaded=True)
+            port = ws.port
+
+        queue = multiprocessing.Queue()
+        viewers = [multiprocessing.Process(target=_ws_reader,
+                                           args=(port, args.duration, queue, args.viewer_rate, args.viewer_deflate))
+                   for _ in range(args.viewers)]
+        with Usage() as usage:
+            for viewer in viewers:
+                viewer.start()
+            outcomes = [queue.get() for _ in viewers]
+            for viewer in viewers:
+                viewer.join()
+
+        if args.bridge_workers:
+            ws.close()
+        else:
+            ws.shutdown_gracefully()
+        vclient.close()
+
+    frames = sum(outcome[0] for outcome in outcomes)
+    latencies = [latency for outcome in outcomes for latency in outcome[2]]
+    results = {
+        'viewers': args.viewers,
+        'bridge_workers': args.bridge_workers,
+        'frames_per_second_per_viewer': round(frames / len(outcomes) / usage.wall, 1),
+        'egress_megabytes': round(sum(outcome[1] for outcome in outcomes) / 1e6, 2),
+        'voyager_events_per_second': round(sum(vclient.metrics.events.values()) / usage.wall, 1)
+    }
+    results.update({key.replace('latency', 'jpg_latency'): value
+                    for key, value in latency_report(latencies).items()})
+    results.update(usage.report())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark VoyagerClient and the websocket bridge "
+                                                 "against a local fake Voyager server")
+    parser.add_argument("scenarios", nargs='*', metavar='scenario',
+                        help=f"Any of {', '.join(SCENARIOS)}, all of them by default")
+    parser.add_argument("-d", "--duration", type=float, default=5)
+    parser.add_argument("--rate", type=float, default=2000, help="ControlData per second for 'events'")
+    parser.add_argument("--jpg-rate", type=float, default=2, help="NewJPGReady per second")
+    parser.add_argument("--jpg-dims", type=int, nargs=2, default=(2328, 1760), metavar=('X', 'Y'))
+    parser.add_argument("--commands", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--bridge-rate", type=float, default=50, help="ControlData/ShotRunning per second for 'bridge'")
+    parser.add_argument("--viewers", type=int, default=10)
+    parser.add_argument("--bridge-workers", type=int, default=0, help="Run the bridge as a hub and this many worker processes")
+    parser.add_argument("--viewer-deflate", action="store_true", default=False,
+                        help="Viewers offer permessage-deflate")
+    parser.add_argument("--batch-ms", type=float, default=0, help="Bridge micro-batching window")
+    parser.add_argument("--viewer-rate", type=float, default=0, help="Max dashboard updates per second each viewer asks for")
+    parser.add_argument("--json", action="store_true", default=False, help="Print results as JSON")
+
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario: {scenario}")
+
+    benches = {'events': bench_events, 'images': bench_images, 'commands': bench_commands, 'bridge': bench_bridge}
+    results = {}
+    for scenario in args.scenarios or SCENARIOS:
+        results[scenario] = benches[scenario](args)
+        if not args.json:
+            print(f"{scenario}: {benches[scenario].__doc__}")
+            for key, value in results[scenario].items():
+                print(f"    {key:32} {value}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+import os
+import re
+import mmap
+import time
+import bisect
+import struct
+import base64
+import logging
+import argparse
+import binascii
+import threading
+import collections
+
+from voyager_api import LAZY_FIELDS, LAZY_FIELD_MIN_SIZE, peek_event
+from fake_voyager import Connection, FakeVoyagerServer, version_banner
+
+log = logging.getLogger(__name__)
+
+INBOUND = 0
+OUTBOUND = 1
+
+MAGIC = b'VCAP\x01\x00\x00\x00'
+
+# <capture>        MAGIC, then per line: timestamp, direction, length, line bytes
+# <capture>.idx    per line: timestamp, offset of its record in <capture>
+# <capture>.blob   decoded Base64Data payloads, referenced from lines as "@blob:offset:length"
+RECORD_HEADER = struct.Struct('<dBI')
+INDEX_ENTRY = struct.Struct('<dQ')
+BLOB_REFERENCE = re.compile(rb'"@blob:(\d+):(\d+)"')
+
+
+class CaptureWriter(object):
+    """Appends a session's raw lines to a capture file.
+
+    Set it as a client's recorder to capture everything it reads and writes:
+
+        client.recorder = CaptureWriter('night.vcap')
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+
+        self._data = open(path, 'wb')
+        self._index = open(path + '.idx', 'wb')
+        self._blobs = open(path + '.blob', 'wb')
+        self._data.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._blob_offset = 0
+        self._lock = threading.Lock()
+
+    def inbound(self, line):
+        self.write(INBOUND, line)
+
+    def outbound(self, line):
+        self.write(OUTBOUND, line.rstrip(b'\r\n'))
+
+    def write(self, direction, line, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if self._data.closed:
+                return
+            if len(line) > LAZY_FIELD_MIN_SIZE:
+                line = self._stash_blobs(line)
+            self._index.write(INDEX_ENTRY.pack(timestamp, self._offset))
+            self._data.write(RECORD_HEADER.pack(timestamp, direction, len(line)))
+            self._data.write(line)
+            self._offset += RECORD_HEADER.size + len(line)
+            self.records += 1
+
+    def _stash_blobs(self, line):
+        """Move large base64 fields to the blob file, stored decoded"""
+        for pattern in LAZY_FIELDS.values():
+            match = pattern.search(line)
+            if not match:
+                continue
+            start = match.end()
+            end = line.find(b'"', start)
+            try:
+                blob = base64.b64decode(memoryview(line)[start:end], validate=True)
+            except (binascii.Error, ValueError):
+                continue  # Not plain base64, leave it in the line
+            self._blobs.write(blob)
+            reference = b'@blob:%d:%d' % (self._blob_offset, len(blob))
+            self._blob_offset += len(blob)
+            line = line[:start] + reference + line[end:]
+        return line
+
+    def flush(self):
+        with self._lock:
+            for file in (self._data, self._index, self._blobs):
+                file.flush()
+
+    def close(self):
+        with self._lock:
+            for file in (self._data, self._index, self._blobs):
+                file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CaptureReader(object):
+    """Memory-mapped, random access view of a capture file.
+
+    Records are found through the index, so seeking to a time or a record number never
+    parses the lines before it. Blob references are only expanded back to base64 when a
+    line is read with expand=True.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        self._data = self._map(path)
+        if self._data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        self._blobs = self._map(path + '.blob')
+
+        index = self._map(path + '.idx')
+        if index is not None and len(index) % INDEX_ENTRY.size == 0:
+            self._timestamps, self._offsets = self._load_index(index)
+        else:
+            log.warning("Index for %s is missing or damaged, rebuilding it", path)
+            self._timestamps, self._offsets = self._scan()
+
+    @staticmethod
+    def _map(path):
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return None
+        with open(path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_index(self, index):
+        timestamps = []
+        offsets = []
+        for timestamp, offset in INDEX_ENTRY.iter_unpack(index):
+            # A crash can leave index entries for records that never reached the disk
+            if offset + RECORD_HEADER.size > len(self._data):
+                break
+            timestamps.append(timestamp)
+            offsets.append(offset)
+        return timestamps, offsets
+
+    def _scan(self):
+        """Walk the record headers, skipping over each line without parsing it"""
+        timestamps = []
+        offsets = []
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= len(self._data):
+            timestamp, _, length = RECORD_HEADER.unpack_from(self._data, offset)
+            if offset + RECORD_HEADER.size + length > len(self._data):
+                break
+            timestamps.append(timestamp)
+            offsets.append(offset)
+            offset += RECORD_HEADER.size + length
+        return timestamps, offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    @property
+    def start_time(self):
+        return self._timestamps[0] if self._timestamps else None
+
+    @property
+    def end_time(self):
+        return self._timestamps[-1] if self._timestamps else None
+
+    def seek(self, timestamp):
+        """Number of the first record at or after timestamp"""
+        return bisect.bisect_left(self._timestamps, timestamp)
+
+    def record(self, number, expand=True):
+        """(timestamp, direction, line) of one record"""
+        offset = self._offsets[number]
+        timestamp, direction, length = RECORD_HEADER.unpack_from(self._data, offset)
+        start = offset + RECORD_HEADER.size
+        line = self._data[start:start + length]
+        if expand and self._blobs is not None:
+            line = self.expand(line)
+        return timestamp, direction, line
+
+    def records(self, start=0, stop=None, direction=None, expand=True):
+        for number in range(start, len(self) if stop is None else min(stop, len(self))):
+            record = self.record(number, expand=False)
+            if direction is not None and record[1] != direction:
+                continue
+            if expand and self._blobs is not None:
+                record = (record[0], record[1], self.expand(record[2]))
+            yield record
+
+    def blob(self, offset, length):
+        return memoryview(self._blobs)[offset:offset + length]
+
+    def expand(self, line):
+        """Put base64 back in place of the blob references in line"""
+        if b'"@blob:' not in line:
+            return line
+        return BLOB_REFERENCE.sub(
+            lambda match: b'"' + base64.b64encode(self.blob(int(match.group(1)), int(match.group(2)))) + b'"',
+            line)
+
+    def summary(self):
+        events = collections.Counter()
+        for _, direction, line in self.records(expand=False):
+            events[(direction, peek_event(line) or 'other')] += 1
+        return {
+            'records': len(self),
+            'start': self.start_time,
+            'end': self.end_time,
+            'bytes': len(self._data),
+            'blob_bytes': len(self._blobs) if self._blobs is not None else 0,
+            'inbound': {event: count for (direction, event), count in events.items() if direction == INBOUND},
+            'outbound': {event: count for (direction, event), count in events.items() if direction == OUTBOUND}
+        }
+
+    def close(self):
+        for mapped in (self._data, self._blobs):
+            if mapped is not None:
+                mapped.close()
+
+
+class ReplayConnection(Connection):
+    """Plays the capture's inbound lines to a client instead of synthetic events"""
+    def _emit(self):
+        reader = self.server.reader
+        speed = self.server.speed
+        start = reader.seek(self.server.start_time) if self.server.start_time else 0
+        if start and not self.send(self._banner(reader, start, self.server.start_time)):
+            return
+
+        first = None
+        began = time.monotonic()
+        for timestamp, _, line in reader.records(start, direction=INBOUND):
+            if self._closed.is_set():
+                return
+            if speed:
+                if first is None:
+                    first = timestamp
+                delay = (timestamp - first) / speed - (time.monotonic() - began)
+                if delay > 0 and self._closed.wait(delay):
+                    return
+            if not self.send(line):
+                return
+
+        log.info("Replay finished after %.1fs", time.monotonic() - began)
+        self.close()
+
+    @staticmethod
+    def _banner(reader, start, timestamp):
+        """Version line to open a replay that starts at record start with. Clients wait for
+        one before sending commands, so a made up one stands in if the capture has none.
+        """
+        for _, _, line in reader.records(0, start, direction=INBOUND, expand=False):
+            if peek_event(line) == 'Version':
+                return line
+        return version_banner(timestamp)
+
+
+class ReplayServer(FakeVoyagerServer):
+    """Serves a capture to any client as if it were a live Voyager.
+
+    speed is a multiple of real time, 0 sends as fast as the client reads. Commands are
+    answered the same way FakeVoyagerServer answers them.
+
+        server = ReplayServer('night.vcap', port=5950, speed=60)
+        server.serve_forever()
+    """
+    connection_class = ReplayConnection
+
+    def __init__(self, path, host='127.0.0.1', port=5950, speed=1.0, start_time=None):
+        super(ReplayServer, self).__init__(host, port)
+        self.reader = CaptureReader(path)
+        self.speed = speed
+        self.start_time = start_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or replay a Voyager session capture")
+    parser.add_argument("action", choices=['info', 'replay'])
+    parser.add_argument("capture")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("-p", "--port", type=int, default=5950)
+    parser.add_argument("-s", "--speed", type=float, default=1.0, help="Multiple of real time, 0 for max speed")
+    parser.add_argument("--start", type=float, default=None, help="Unix time to start the replay from")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == 'info':
+        for key, value in CaptureReader(args.capture).summary().items():
+            print(f"{key:12} {value}")
+    else:
+        server = ReplayServer(args.capture, args.host, args.port, args.speed, args.start)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
@@ -0,0 +1,178 @@
+import json
+import time
+import logging
+import threading
+
+from ws_transport import LATEST, encode_frame
+
+log = logging.getLogger(__name__)
+
+
+def diff_state(old, new):
+    """Sections and fields of new that differ from old, in the same nested shape"""
+    patch = {}
+    for section, fields in new.items():
+        current = old.get(section, {})
+        changed = {key: value for key, value in fields.items() if key not in current or current[key] != value}
+        if changed:
+            patch[section] = changed
+    return patch
+
+
+def merge_state(state, patch):
+    for section, fields in patch.items():
+        state.setdefault(section, {}).update(fields)
+
+
+class _ClientView(object):
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.pending = {}
+        self.last_sent = 0.0
+
+    def due(self):
+        return self.last_sent + 1 / self.max_rate
+
+
+class DashboardBroadcaster(object):
+    """Keeps the latest dashboard state and sends clients only what changed.
+
+    update() takes the full {section: {field: value}} struct, and clients get a patch of
+    the same shape holding only the fields that changed, so the dashboard's existing
+    per-field rendering works on patches and snapshots alike. A client that asked for a
+    max_rate gets changes coalesced into one patch per 1 / max_rate seconds. Everyone gets
+    the full state on connecting, on asking for it, and every snapshot_interval seconds.
+    """
+    def __init__(self, server, snapshot_interval=30):
+        self.server = server
+        self.snapshot_interval = snapshot_interval
+        self.state = {}
+
+        self._state_frame = None
+        self._views = {}
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._last_snapshot = time.monotonic()
+        threading.Thread(target=self._run, name='DashboardBroadcaster', daemon=True).start()
+
+    def update(self, datastruct):
+        with self._lock:
+            patch = diff_state(self.state, datastruct)
+            if patch:
+                self.apply(patch)
+
+    def apply(self, patch, frame=None):
+        """Merge a patch into the state and send it on, frame being its encoding if known"""
+        with self._lock:
+            merge_state(self.state, patch)
+            self._state_frame = None
+
+            frames = {'patch': frame} if frame else {}
+            for client in list(self.server.clients):
+                view = self._views.get(client['id'])
+                if view is None or not view.max_rate:
+                    self._send(client, patch, frames)
+                else:
+                    merge_state(view.pending, patch)
+        self._wake.set()
+
+    def _send(self, client, patch, frames):
+        """Queue patch for client, or the whole state if its last one is still queued.
+
+        Patches aren't LATEST-safe on their own, replacing a queued patch would lose its
+        fields, but the full state replaces either. frames caches the encoding of one patch.
+        """
+        if self.server.has_pending(client, 'dashboard'):
+            frame = self.state_frame()
+        else:
+            if 'patch' not in frames:
+                frames['patch'] = encode_frame(json.dumps(patch))
+            frame = frames['patch']
+        self.server.send_frame(client, frame, LATEST, 'dashboard')
+
+    def set_rate(self, client, max_rate):
+        """Limit client to max_rate updates per second, 0 or None for every change"""
+        with self._lock:
+            view = self._views.setdefault(client['id'], _ClientView(max_rate))
+            view.max_rate = max_rate
+        self._wake.set()
+
+    def state_frame(self):
+        """The full state, encoded once per change"""
+        with self._lock:
+            if self._state_frame is None:
+                self._state_frame = encode_frame(json.dumps(self.state))
+            return self._state_frame
+
+    def send_snapshot(self, client=None):
+        """Full state to client, or to everyone"""
+        with self._lock:
+            if not self.state:
+                return
+            frame = self.state_frame()
+            for target in [client] if client else list(self.server.clients):
+                self.server.send_frame(target, frame, LATEST, 'dashboard')
+                view = self._views.get(target['id'])
+                if view:
+                    view.pending = {}
+                    view.last_sent = time.monotonic()
+
+    def forget(self, client):
+        with self._lock:
+            self._views.pop(client['id'], None)
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.clear()
+            now = time.monotonic()
+            if self.snapshot_interval and now - self._last_snapshot >= self.snapshot_interval:
+                self._last_snapshot = now
+                self.send_snapshot()
+
+            with self._lock:
+                clients = {client['id']: client for client in self.server.clients}
+                next_due = self._last_snapshot + self.snapshot_interval if self.snapshot_interval else now + 1
+                for client_id, view in list(self._views.items()):
+                    if client_id not in clients:
+                        del self._views[client_id]
+                        continue
+                    if not view.max_rate or not view.pending:
+                        continue
+                    if view.due() <= now:
+                        self._send(clients[client_id], view.pending, {})
+                        view.pending = {}
+                        view.last_sent = now
+                    else:
+                        next_due = min(next_due, view.due())
+
+            self._wake.wait(max(0.0, next_due - time.monotonic()))
+
+
+class TopicCache(object):
+    """Latest encoded frame of each topic, so a client that connects gets the last shot
+    and the last image straight away instead of waiting for Voyager to send new ones.
+    """
+    def __init__(self, server):
+        self.server = server
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def publish(self, topic, frame, policy=LATEST):
+        """Keep frame as topic's latest and send it to everyone"""
+        with self._lock:
+            self._frames[topic] = (frame, policy)
+            self.server.send_frame_to_all(frame, policy, topic)
+
+    def replay(self, client):
+        with self._lock:
+            for topic, (frame, policy) in self._frames.items():
+                self.server.send_frame(client, frame, policy, topic)
+
+    def topics(self):
+        with self._lock:
+            return list(self._frames)
@@ -0,0 +1,329 @@
+import io
+import json
+import time
+import math
+import base64
+import random
+import socket
+import logging
+import argparse
+import threading
+import collections
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+log = logging.getLogger(__name__)
+
+# Events per second emitted to every connected client, 0 turns an event off
+DEFAULT_RATES = {
+    'Polling': 0.2,
+    'ControlData': 1,
+    'ShotRunning': 1,
+    'LogEvent': 2,
+    'Signal': 0.1,
+    'NewJPGReady': 1 / 60
+}
+
+
+def _control_data(n, now):
+    return {
+        'Event': 'ControlData',
+        'Timestamp': now,
+        'Host': 'FAKEVOYAGER',
+        'Inst': 1,
+        'VOYSTAT': 2,
+        'SETUPCONN': True,
+        'RUNSEQ': 'M31.s2q',
+        'RUNDS': '',
+        'SEQNAME': 'M31',
+        'SEQSTART': '22:01:05',
+        'SEQEND': '04:12:45',
+        'SEQREMAIN': '05:%02d:%02d' % (59 - n // 60 % 60, 59 - n % 60),
+        'CCDCONN': True,
+        'CCDTEMP': round(-10 + random.gauss(0, 0.1), 2),
+        'CCDPOW': 40 + n % 3,
+        'CCDSETP': -10,
+        'CCDCOOL': True,
+        'CCDSTAT': 5,
+        'MNTCONN': True,
+        'MNTPARK': False,
+        'MNTRA': '00:42:44',
+        'MNTDEC': '+41:16:09',
+        'MNTALT': '%.2f' % (60 + 10 * math.sin(n / 3600)),
+        'MNTAZ': '%.2f' % (120 + n / 240 % 240),
+        'MNTPIER': 'pierEast',
+        'MNTTFLIP': '01:02:03',
+        'MNTSLEW': False,
+        'MNTTRACK': True,
+        'AFCONN': True,
+        'AFTEMP': round(8 - n / 3600, 2),
+        'AFPOS': 12000 + n // 600 * 5,
+        'GUIDECONN': True,
+        'GUIDESTAT': 2,
+        'GUIDEX': round(random.gauss(0, 0.4), 3),
+        'GUIDEY': round(random.gauss(0, 0.3), 3)
+    }
+
+
+def _shot_running(n, now):
+    return {
+        'Event': 'ShotRunning',
+        'Timestamp': now,
+        'Host': 'FAKEVOYAGER',
+        'Inst': 1,
+        'File': 'M31_LIGHT_L_300s_BIN1_-10C_%04d.fit' % (n // 300),
+        'Expo': 300,
+        'Elapsed': n % 300,
+        'ElapsedPerc': round((n % 300) / 3, 1),
+        'Status': 1
+    }
+
+
+def _log_event(n, now):
+    return {
+        'Event': 'LogEvent',
+        'Timestamp': now,
+        'Host': 'FAKEVOYAGER',
+        'Inst': 1,
+        'TimeInfo': now,
+        'Type': 1 + n % 4,
+        'Text': f"Fake log line {n}"
+    }
+
+
+def _signal(n, now):
+    return {
+        'Event': 'Signal',
+        'Timestamp': now,
+        'Host': 'FAKEVOYAGER',
+        'Inst': 1,
+        'Code': (18, 20, 24, 501, 502)[n % 5]
+    }
+
+
+def _polling(n, now):
+    return {'Event': 'Polling', 'Timestamp': now, 'Host': 'FAKEVOYAGER', 'Inst': 1}
+
+
+def make_jpeg_base64(width, height, quality=90):
+    """Base64 of a noisy width x height JPEG, or random bytes of similar size without PIL"""
+    if Image is None:
+        return base64.b64encode(random.randbytes(width * height // 4)).decode()
+    image = Image.effect_noise((width, height), 48).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def version_banner(timestamp):
+    """The Version event Voyager greets every client with"""
+    return json.dumps({'Event': 'Version', 'Timestamp': timestamp, 'Host': 'FAKEVOYAGER', 'Inst': 1,
+                       'VOYVersion': 'Release 2.3.0 - Fake', 'VOYSubver': '', 'MsgVersion': 1})
+
+
+class Connection(object):
+    """One client session: an emitter thread for events and a reader for commands"""
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._send_lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._emit, name='FakeVoyagerEmit', daemon=True).start()
+        threading.Thread(target=self._serve_commands, name='FakeVoyagerCommands', daemon=True).start()
+
+    def close(self):
+        self._closed.set()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode()
+        with self._send_lock:
+            try:
+                self.conn.sendall(line + b'\r\n')
+                return True
+            except OSError:
+                self._closed.set()
+                return False
+
+    def _emit(self):
+        self.send(version_banner(time.time()))
+
+        start = time.monotonic()
+        schedule = {event: start for event, rate in self.server.rates.items() if rate > 0}
+        counts = collections.Counter()
+        while schedule and not self._closed.is_set():
+            event = min(schedule, key=schedule.get)
+            delay = schedule[event] - time.monotonic()
+            if delay > 0 and self._closed.wait(delay):
+                break
+            if not self.send(self.server.build(event, counts[event], time.time())):
+                break
+            counts[event] += 1
+            schedule[event] += 1 / self.server.rates[event]
+
+    def _serve_commands(self):
+        reader = self.conn.makefile('rb')
+        try:
+            for line in reader:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                key = message.get('Event') or message.get('method')
+                self.server.received[key] += 1
+                if message.get('method') == 'disconnect':
+                    break
+                if 'method' in message:
+                    self._answer(message)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def _answer(self, message):
+        self.send(json.dumps({'jsonrpc': '2.0', 'result': 0, 'id': message.get('id')}))
+        result = json.dumps({
+            'Event': 'RemoteActionResult',
+            'Timestamp': time.time(),
+            'Host': 'FAKEVOYAGER',
+            'Inst': 1,
+            'UID': message.get('params', {}).get('UID'),
+            'ActionResultInt': self.server.action_result,
+            'Motivo': '',
+            'ParamRet': {}
+        })
+        if self.server.command_delay:
+            threading.Timer(self.server.command_delay, self.send, (result,)).start()
+        else:
+            self.send(result)
+
+
+class FakeVoyagerServer(object):
+    """Stand-in for the Voyager application server, for benchmarks and local testing.
+
+    Every client gets the Version banner, then a stream of events at the rates given
+    (events per second). Commands are acknowledged and answered with a RemoteActionResult
+    after command_delay seconds.
+
+        server = FakeVoyagerServer(port=0, rates={'ControlData': 500})
+        server.start()
+        client = VoyagerClient('127.0.0.1', server.port)
+    """
+    connection_class = Connection
+    builders = {
+        'Polling': _polling,
+        'ControlData': _control_data,
+        'ShotRunning': _shot_running,
+        'LogEvent': _log_event,
+        'Signal': _signal
+    }
+
+    def __init__(self, host='127.0.0.1', port=5950, rates=None, jpg_dims=(2328, 1760),
+                 command_delay=0.0, action_result=4):
+        self.host = host
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.jpg_dims = jpg_dims
+        self.command_delay = command_delay
+        self.action_result = action_result
+
+        # Inbound traffic seen across all connections, by Event or method
+        self.received = collections.Counter()
+
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self.port = self._sock.getsockname()[1]
+        self._sock.listen()
+
+        self._jpg_base64 = None
+        self._shut_down = threading.Event()
+        self._connections = []
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='FakeVoyager', daemon=True).start()
+
+    def serve_forever(self):
+        log.info("Fake Voyager listening on %s:%d", self.host, self.port)
+        while not self._shut_down.is_set():
+            try:
+                conn, address = self._sock.accept()
+            except OSError:
+                break
+            log.info("Client connected from %s", address)
+            connection = self.connection_class(self, conn)
+            self._connections.append(connection)
+            connection.start()
+
+    def stop(self):
+        self._shut_down.set()
+        try:
+            # Wakes the accept() in serve_forever, closing alone leaves it listening
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        for connection in self._connections:
+            connection.close()
+
+    def new_jpg_ready(self, n, now):
+        if self._jpg_base64 is None:
+            self._jpg_base64 = make_jpeg_base64(*self.jpg_dims)
+        header = {
+            'Event': 'NewJPGReady',
+            'Timestamp': now,
+            'Host': 'FAKEVOYAGER',
+            'Inst': 1,
+            'File': 'M31_LIGHT_L_300s_BIN1_-10C_%04d.fit' % n,
+            'SequenceTarget': 'M31',
+            'TimeInfo': now,
+            'Expo': 300,
+            'Bin': 1,
+            'Filter': 'LRGB'[n % 4],
+            'HFD': round(2.2 + random.gauss(0, 0.15), 2),
+            'StarIndex': round(8 + random.gauss(0, 0.5), 2),
+            'PixelDimX': self.jpg_dims[0],
+            'PixelDimY': self.jpg_dims[1]
+        }
+        # Skip re-encoding the image data for every frame
+        return json.dumps(header)[:-1] + ', "Base64Data": "' + self._jpg_base64 + '"}'
+
+    def build(self, event, n, now):
+        if event == 'NewJPGReady':
+            return self.new_jpg_ready(n, now)
+        return json.dumps(self.builders[event](n, now))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for a Voyager application server")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("-p", "--port", type=int, default=5950)
+    parser.add_argument("--rate", action='append', default=[], metavar='EVENT=PER_SECOND',
+                        help="Emission rate for an event, e.g. --rate ControlData=100")
+    parser.add_argument("--jpg-dims", type=int, nargs=2, default=(2328, 1760), metavar=('X', 'Y'))
+    parser.add_argument("--command-delay", type=float, default=0.0)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    rates = {}
+    for rate in args.rate:
+        event, per_second = rate.split('=')
+        rates[event] = float(per_second)
+
+    server = FakeVoyagerServer(args.host, args.port, rates, tuple(args.jpg_dims), args.command_delay)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,341 @@
+import os
+import json
+import glob
+import logging
+import threading
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# ControlData fields kept by default
+FIELDS = ('CCDTEMP', 'CCDPOW', 'AFTEMP', 'AFPOS', 'MNTALT', 'GUIDEX', 'GUIDEY')
+
+# Samples per aggregate bucket at each level of a segment's summary pyramid
+LEVELS = (16, 256, 4096)
+
+SEGMENT_MAGIC = b'VTLMSEG1'
+
+
+def _write_arrays(path, arrays):
+    """Lay named arrays out in one file behind a JSON directory, each one 8 byte aligned
+    so it can be memory mapped straight back
+    """
+    directory = {}
+    offset = 0
+    for name, array in arrays.items():
+        directory[name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset}
+        offset += -(-array.nbytes // 8) * 8
+    header = json.dumps(directory).encode()
+    header += b' ' * (-(len(SEGMENT_MAGIC) + 8 + len(header)) % 8)
+
+    with open(path + '.tmp', 'wb') as file:
+        file.write(SEGMENT_MAGIC + len(header).to_bytes(8, 'little') + header)
+        for array in arrays.values():
+            data = np.ascontiguousarray(array).tobytes()
+            file.write(data + b'\0' * (-len(data) % 8))
+    os.replace(path + '.tmp', path)
+
+
+def _map_arrays(path):
+    with open(path, 'rb') as file:
+        if file.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is not a telemetry segment")
+        header_length = int.from_bytes(file.read(8), 'little')
+        directory = json.loads(file.read(header_length))
+    base = len(SEGMENT_MAGIC) + 8 + header_length
+    return {name: np.memmap(path, dtype=entry['dtype'], mode='r', offset=base + entry['offset'],
+                            shape=tuple(entry['shape']))
+            for name, entry in directory.items()}
+
+
+def _summarize(timestamps, columns, size):
+    """Per bucket of size samples: start time, and min, max, sum and count of each column"""
+    starts = np.arange(0, len(timestamps), size)
+    summary = {'t': np.asarray(timestamps[starts], dtype=np.float64)}
+    for field, values in columns.items():
+        values = np.asarray(values)
+        valid = ~np.isnan(values)
+        summary[field + '.min'] = np.fmin.reduceat(values, starts).astype(np.float32)
+        summary[field + '.max'] = np.fmax.reduceat(values, starts).astype(np.float32)
+        summary[field + '.sum'] = np.add.reduceat(np.where(valid, values, 0), starts, dtype=np.float64)
+        summary[field + '.count'] = np.add.reduceat(valid, starts, dtype=np.uint32)
+    return summary
+
+
+class Segment(object):
+    """A run of samples: timestamps and one float32 column per field, plus a pyramid of
+    bucket summaries so long ranges are answered from a handful of buckets.
+    """
+    def __init__(self, timestamps, columns, levels=None):
+        self.timestamps = timestamps
+        self.columns = columns
+        self.levels = levels if levels is not None else {
+            size: _summarize(timestamps, columns, size) for size in LEVELS if size < len(timestamps)}
+
+    @classmethod
+    def load(cls, path):
+        arrays = _map_arrays(path)
+        columns = {name[4:]: array for name, array in arrays.items() if name.startswith('raw.')}
+        levels = {}
+        for name, array in arrays.items():
+            if name.startswith('L'):
+                size, key = name[1:].split('/', 1)
+                levels.setdefault(int(size), {})[key] = array
+        return cls(arrays['t'], columns, levels)
+
+    def save(self, path):
+        arrays = {'t': self.timestamps}
+        arrays.update(('raw.' + field, values) for field, values in self.columns.items())
+        for size, summary in self.levels.items():
+            arrays.update((f"L{size}/{key}", array) for key, array in summary.items())
+        _write_arrays(path, arrays)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def start(self):
+        return float(self.timestamps[0])
+
+    @property
+    def end(self):
+        return float(self.timestamps[-1])
+
+    def rows(self, start, end):
+        first, last = np.searchsorted(self.timestamps, (start, end))
+        return int(first), int(last)
+
+    def source(self, start, end, max_bucket, fields):
+        """Timestamps and summaries covering [start, end), from the coarsest level with
+        buckets of max_bucket samples or fewer. Samples at either end of the range that
+        only fill part of a bucket are taken raw.
+        """
+        first, last = self.rows(start, end)
+        for size in sorted(self.levels, reverse=True):
+            if size > max_bucket:
+                continue
+            summary = self.levels[size]
+            first_bucket = -(-first // size)
+            last_bucket = last // size
+            if first_bucket >= last_bucket:
+                continue  # No whole bucket of this level in the range
+            head = self._raw(first, first_bucket * size, fields)
+            tail = self._raw(last_bucket * size, last, fields)
+            return {key: np.concatenate((head[key], summary[key][first_bucket:last_bucket], tail[key]))
+                    for key in head}
+        return self._raw(first, last, fields)
+
+    def _raw(self, first, last, fields):
+        summary = {'t': np.asarray(self.timestamps[first:last], dtype=np.float64)}
+        for field in fields:
+            values = np.asarray(self.columns[field][first:last], dtype=np.float32)
+            summary[field + '.min'] = summary[field + '.max'] = values
+            summary[field + '.sum'] = np.nan_to_num(values).astype(np.float64)
+            summary[field + '.count'] = (~np.isnan(values)).astype(np.uint32)
+        return summary
+
+
+class TelemetryStore(object):
+    """Typed, columnar history of ControlData fields.
+
+    Samples go into preallocated numpy columns of segment_size rows (8 bytes for the
+    timestamp and 4 per field, instead of a dict per sample), and into the summary levels
+    of the segment as they arrive, so the segment being filled is queried like any other.
+    A full segment is, given a path, written out and memory mapped back. Without a path the last
+    max_segments are kept in memory. query() answers a time range with min, max and mean
+    per bin from the summaries, so its cost follows the number of bins, not of samples.
+
+        store = TelemetryStore('telemetry')
+        store.attach(client)
+        chart = store.query('CCDTEMP', start, end, points=500)
+    """
+    def __init__(self, path=None, fields=FIELDS, segment_size=65536, max_segments=None):
+        self.path = path
+        self.fields = tuple(fields)
+        self.segment_size = segment_size
+        self.max_segments = max_segments if max_segments is not None else (None if path else 8)
+
+        self.segments = []
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._new_active()
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+            for segment_path in sorted(glob.glob(os.path.join(path, '*.seg'))):
+                try:
+                    self.segments.append(Segment.load(segment_path))
+                except (OSError, ValueError) as e:
+                    log.warning("Skipping telemetry segment %s: %r", segment_path, e)
+
+    def _new_active(self):
+        self._timestamps = np.empty(self.segment_size, dtype=np.float64)
+        self._columns = {field: np.empty(self.segment_size, dtype=np.float32) for field in self.fields}
+        self._count = 0
+
+        # Bucket summaries of the active segment, one row per bucket and a column per field
+        self._levels = {}
+        for size in LEVELS:
+            buckets = -(-self.segment_size // size)
+            self._levels[size] = {
+                't': np.empty(buckets, dtype=np.float64),
+                'min': np.empty((buckets, len(self.fields)), dtype=np.float32),
+                'max': np.empty((buckets, len(self.fields)), dtype=np.float32),
+                'sum': np.empty((buckets, len(self.fields)), dtype=np.float64),
+                'count': np.empty((buckets, len(self.fields)), dtype=np.uint32)
+            }
+
+    def _summarize_row(self, row, timestamp, values):
+        valid = ~np.isnan(values)
+        present = np.where(valid, values, 0)
+        for size, level in self._levels.items():
+            bucket, offset = divmod(row, size)
+            if not offset:
+                level['t'][bucket] = timestamp
+                level['min'][bucket] = level['max'][bucket] = values
+                level['sum'][bucket] = present
+                level['count'][bucket] = valid
+            else:
+                np.fmin(level['min'][bucket], values, out=level['min'][bucket])
+                np.fmax(level['max'][bucket], values, out=level['max'][bucket])
+                level['sum'][bucket] += present
+                level['count'][bucket] += valid
+
+    def _active_levels(self, partial, fields=None):
+        """Summary levels of the active segment as Segment takes them, with the bucket the
+        newest sample is in only if partial
+        """
+        fields = self.fields if fields is None else fields
+        levels = {}
+        for size, level in self._levels.items():
+            if size >= self._count:
+                continue
+            buckets = -(-self._count // size) if partial else self._count // size
+            summary = {'t': level['t'][:buckets]}
+            for field in fields:
+                i = self.fields.index(field)
+                for key in ('min', 'max', 'sum', 'count'):
+                    summary[f"{field}.{key}"] = level[key][:buckets, i]
+            levels[size] = summary
+        return levels
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments) + self._count
+
+    def attach(self, client):
+        """Record ControlData from a VoyagerClient as it arrives.
+
+        Samples are taken on the client's handler pool, so a slow disk while a segment
+        is written out never holds up the receive thread. They queue up meanwhile, and
+        only the oldest are dropped if the queue overflows.
+        """
+        self._handlers[client] = client.add_handler('ControlData', self.observe, queue_size=1000,
+                                                    overflow='drop_oldest')
+
+    def detach(self, client):
+        client.remove_handler('ControlData', self._handlers.pop(client))
+
+    def observe(self, message):
+        timestamp = message.get('Timestamp')
+        if message.get('Event') == 'ControlData' and timestamp is not None:
+            self.append(timestamp, message)
+
+    def append(self, timestamp, values):
+        """Add a sample; values maps field names to numbers, strings of numbers are fine too"""
+        sample = np.empty(len(self.fields), dtype=np.float32)
+        for i, field in enumerate(self.fields):
+            try:
+                sample[i] = float(values[field])
+            except (KeyError, TypeError, ValueError):
+                sample[i] = np.nan
+
+        with self._lock:
+            row = self._count
+            self._timestamps[row] = timestamp
+            for value, column in zip(sample, self._columns.values()):
+                column[row] = value
+            self._summarize_row(row, timestamp, sample)
+            self._count += 1
+            if self._count == self.segment_size:
+                self._spill()
+
+    def _active_segment(self, partial, fields=None):
+        count = self._count
+        fields = self.fields if fields is None else fields
+        return Segment(self._timestamps[:count], {field: self._columns[field][:count] for field in fields},
+                       self._active_levels(partial, fields))
+
+    def _spill(self):
+        segment = self._active_segment(partial=True)
+        if self.path:
+            segment_path = os.path.join(self.path, '%017.6f.seg' % segment.start)
+            segment.save(segment_path)
+            segment = Segment.load(segment_path)
+        self.segments.append(segment)
+        if self.max_segments and len(self.segments) > self.max_segments:
+            self.segments.pop(0)
+        self._new_active()
+
+    def flush(self):
+        """Write out the samples so far as a segment of their own"""
+        with self._lock:
+            if self._count:
+                self._spill()
+
+    def latest(self):
+        """(timestamp, {field: value}) of the newest sample, or None"""
+        with self._lock:
+            if self._count:
+                row = self._count - 1
+                return float(self._timestamps[row]), {f: float(c[row]) for f, c in self._columns.items()}
+        if self.segments:
+            segment = self.segments[-1]
+            return segment.end, {f: float(c[-1]) for f, c in segment.columns.items()}
+        return None
+
+    def query(self, fields, start, end, points=500):
+        """Downsample fields over [start, end) into points equal time bins.
+
+        Returns {'t': bin start times, field: {'min', 'max', 'mean', 'count'}}, with NaN
+        in bins that have no samples.
+        """
+        if isinstance(fields, str):
+            fields = [fields]
+        edges = np.linspace(start, end, points + 1)
+        result = {'t': edges[:-1]}
+        mins = {field: np.full(points, np.nan) for field in fields}
+        maxs = {field: np.full(points, np.nan) for field in fields}
+        sums = {field: np.zeros(points) for field in fields}
+        counts = {field: np.zeros(points, dtype=np.int64) for field in fields}
+
+        with self._lock:
+            sources = [segment for segment in self.segments if segment.end >= start and segment.start < end]
+            if self._count:
+                # Rows and whole buckets before _count never change, so views are enough
+                sources.append(self._active_segment(partial=False, fields=fields))
+
+        # Two buckets or more to a bin keeps the bins' edges close to exact
+        samples = sum(last - first for first, last in (segment.rows(start, end) for segment in sources))
+        max_bucket = samples / (points * 2)
+
+        for segment in sources:
+            summary = segment.source(start, end, max_bucket, fields)
+            timestamps = summary['t']
+            if not len(timestamps):
+                continue
+            # Buckets are sorted by time, so each bin is a contiguous run of them
+            bounds = np.searchsorted(timestamps, edges)
+            bins = np.flatnonzero(bounds[1:] > bounds[:-1])
+            offsets = bounds[bins]
+            for field in fields:
+                mins[field][bins] = np.fmin(mins[field][bins], np.fmin.reduceat(summary[field + '.min'], offsets))
+                maxs[field][bins] = np.fmax(maxs[field][bins], np.fmax.reduceat(summary[field + '.max'], offsets))
+                sums[field][bins] += np.add.reduceat(summary[field + '.sum'], offsets)
+                counts[field][bins] += np.add.reduceat(summary[field + '.count'], offsets, dtype=np.int64)
+
+        for field in fields:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = sums[field] / counts[field]
+            result[field] = {'min': mins[field], 'max': maxs[field], 'mean': mean, 'count': counts[field]}
+        return result
@@ -0,0 +1,144 @@
+import io
+import base64
+import logging
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+# Thumbnail sizes made from every frame, as a fraction (1 / n) of the sensor size
+PRESETS = {
+    'thumb': 18,
+    'preview': 6
+}
+
+
+def make_thumbnails(jpeg, presets=None, quality=85):
+    """Decode a JPEG once at the smallest scale that still covers every preset, then
+    resize and re-encode it for each of them.
+
+    Runs in a worker process. Returns {preset: (jpeg bytes, (width, height))}.
+    """
+    presets = presets or PRESETS
+    img = Image.open(io.BytesIO(jpeg))
+    full_size = img.size
+    sizes = {name: (max(1, int(full_size[0] / scale)), max(1, int(full_size[1] / scale)))
+             for name, scale in presets.items()}
+
+    # libjpeg can scale by 1/2, 1/4 or 1/8 while decoding, which skips most of the work
+    largest = max(sizes.values())
+    img.draft('RGB', largest)
+    img = img.convert('RGB')
+
+    thumbnails = {}
+    for name, size in sizes.items():
+        buffer = io.BytesIO()
+        img.resize(size, Image.BILINEAR, reducing_gap=2.0).save(buffer, format='JPEG', quality=quality)
+        thumbnails[name] = (buffer.getvalue(), size)
+    return thumbnails
+
+
+class ThumbnailPipeline(object):
+    """Makes thumbnails of NewJPGReady frames in a process pool and caches them by File.
+
+    submit() returns a Future, or None when the frame's payload was already dropped from
+    its BlobStore. A frame that is already done or in progress is never decoded twice, so
+    a client reconnecting or asking for an older frame costs nothing. The original JPEG of
+    the last keep_originals frames is kept for full resolution fetches, as the message's
+    Blob handle when it has one.
+
+        pipeline = ThumbnailPipeline()
+        future = pipeline.submit(message)
+        if future is not None:
+            future.add_done_callback(send_to_clients)
+    """
+    def __init__(self, presets=None, workers=2, cache_size=32, quality=85, keep_originals=4):
+        self.presets = dict(presets or PRESETS)
+        self.workers = workers
+        self.cache_size = cache_size
+        self.quality = quality
+        self.keep_originals = keep_originals
+
+        self._cache = collections.OrderedDict()
+        self._originals = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # Not forked, the bridge process is full of threads
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def start(self):
+        """Spawn the workers now, rather than delaying the first frame by the startup time"""
+        for future in [self.executor.submit(int) for _ in range(self.workers)]:
+            future.result()
+
+    def submit(self, message):
+        file = message['File']
+        with self._lock:
+            future = self._cache.get(file)
+            if future is not None:
+                self._cache.move_to_end(file)
+                return future
+
+            blob = message.blob('Base64Data') if hasattr(message, 'blob') else None
+            if blob is not None:
+                jpeg = blob.bytes()
+                if jpeg is None:
+                    log.warning("Skipping %s, its image was dropped before it could be processed", file)
+                    return None
+            else:
+                jpeg = base64.b64decode(message['Base64Data'])
+            future = self.executor.submit(make_thumbnails, jpeg, self.presets, self.quality)
+            future.add_done_callback(lambda done: self._check(file, done))
+
+            self._cache[file] = future
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+            self._originals[file] = blob if blob is not None else jpeg
+            while len(self._originals) > self.keep_originals:
+                self._originals.popitem(last=False)
+            return future
+
+    def _check(self, file, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        log.error("Thumbnails failed for %s: %r", file, future.exception())
+        with self._lock:
+            # Let the next NewJPGReady for this file try again
+            if self._cache.get(file) is future:
+                del self._cache[file]
+
+    def get(self, file):
+        """Finished thumbnails of file, or None"""
+        with self._lock:
+            future = self._cache.get(file)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def original(self, file):
+        """Full resolution JPEG of file, bytes-like, or None once it has aged out"""
+        with self._lock:
+            original = self._originals.get(file)
+        if hasattr(original, 'view'):
+            return original.view()
+        return original
+
+    def files(self):
+        with self._lock:
+            return list(self._cache)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -1,22 +1,65 @@
+import os
 import time
+import re
+import mmap
 import json
+import asyncio
 import uuid
 import queue
 import socket
 import base64
+import weakref
+import binascii
+import bisect
 import random
+import fnmatch
+import selectors
 import logging
+import functools
+import itertools
 import threading
 import collections
+import concurrent.futures
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 log = logging.getLogger(__name__)
 
+json_loads = orjson.loads if orjson else json.loads
+
+# Voyager puts Event first, so its name can be read without parsing the whole line
+EVENT_PATTERN = re.compile(rb'"Event"\s*:\s*"([^"]*)"')
+EVENT_PEEK_SIZE = 128
+
+# String fields that can be megabytes long are cut out before parsing and kept as raw
+# bytes on the VoyagerMessage until a handler actually reads them. All of them are base64,
+# given a BlobStore they are decoded into it instead.
+LAZY_FIELDS = {name: re.compile(rb'"' + name + rb'"\s*:\s*"') for name in (b'Base64Data',)}
+LAZY_FIELD_MIN_SIZE = 4096
+
+# Events the receive loop itself acts on, these are always decoded
+ROUTED_EVENTS = frozenset(('Version', 'Polling', 'Signal', 'LogEvent', 'ShutDown', 'RemoteActionResult'))
+
 
 class VoyagerClient(threading.Thread):
+    command_timeouts_default = {
+        'GetArrayElementData': 30,
+        'RemoteFilterGetActual': 30,
+        'RemoteGetFilterConfiguration': 30,
+        'RemoteGetCCDTemperature': 30,
+        'RemoteSetLogEvent': 30,
+        'RemoteSetDashboardMode': 30
+    }
+
     def __init__(self,
                  host,
                  port,
                  client_id=None,
+                 handler_workers=4,
+                 dispatcher=None,
                  group=None,
                  target=None,
                  name=None,
@@ -30,20 +73,39 @@ class VoyagerClient(threading.Thread):
         if not self.client_id:
             self.client_id = random.randrange(1, 10)
 
-        self.cmd_running = None
+        # Seconds a command may take before send_command gives up, None waits forever
+        self.command_timeout = None
+        self.command_timeouts = dict(self.command_timeouts_default)
 
-        self.cmd_assembly = collections.deque()
+        # Each buffer numbers its entries, so readers can ask for everything after the last
+        # sequence number they saw with since(). Logs are indexed by level name, signals
+        # by Code and messages by Event, e.g. client.logs.since(seq, key='WARNING').
+        # log_length, signals_length and messages_length resize them.
+        self.logs = RingBuffer(1000, index=self._log_level)
+        self.signals = RingBuffer(20, index=lambda message: message.get('Code'))
+        self.messages = RingBuffer(30, index=self._message_event, decode=self._decode_deferred)
 
-        self.log_length = 1000
-        self.signals_length = 20
-        self.messages_length = 30
-
-        self.logs = collections.deque()
-        self.signals = collections.deque()
-        self.messages = collections.deque()
+        # Position of get_message() and get_signal() in their buffers
+        self._message_cursor = 0
+        self._signal_cursor = 0
 
         self.sock = socket.socket()
         self.sock.settimeout(0.15)
+        self.connect_timeout = 10
+        self._selector = None
+
+        # A dropped link or a Voyager restart is followed by a new connection attempt after
+        # a delay that doubles from reconnect_delay up to reconnect_max_delay, with jitter.
+        # Kept short, a Voyager that comes back is live again within a second.
+        self.reconnect = True
+        self.reconnect_delay = 0.1
+        self.reconnect_max_delay = 1.0
+
+        self.recv_size = 65536
+        self._recv_chunk = bytearray(self.recv_size)
+        self._recv_view = memoryview(self._recv_chunk)
+        self._recv_buffer = bytearray()
+        self._scan_pos = 0
 
         self.heartbeat_events = [
             'WeatherAndSafetyMonitorData',
@@ -56,186 +118,448 @@ class VoyagerClient(threading.Thread):
         self._shut_down.clear()
 
         self._connected = False
+        self._ready = threading.Event()
+        # Connections Voyager greeted so far. Settings are only restored on later ones,
+        # on the first the commands that made them are still on their way out.
+        self._sessions = 0
+
+        # Voyager drops clients it hasn't heard from in a while. Any write counts, so a
+        # Polling only goes out when nothing else was sent for heartbeat_interval seconds.
+        self.heartbeat_interval = 5
+        self._last_send = 0
+
+        # Outbound messages from every thread are appended here and written by the
+        # receive thread, so bursts leave in as few send() calls as possible
+        self._write_buffer = bytearray()
+        self._send_lock = threading.Lock()
+        self._want_write = False
+
+        self.handlers = HandlerRegistry()
+
+        # Overflow policy used when a handler is added without one. State-like events only
+        # matter in their newest form, so a slow consumer just sees the latest update.
+        self.handler_queue_size = 100
+        self.handler_overflow = {
+            'ControlData': 'latest',
+            'ShotRunning': 'latest',
+            'WeatherAndSafetyMonitorData': 'latest',
+            'NewJPGReady': 'drop_oldest'
+        }
+        # A VoyagerMultiplexer hands every client it drives one shared dispatcher
+        self.dispatcher = dispatcher or Dispatcher(workers=handler_workers)
+        self._owns_dispatcher = dispatcher is None
 
-        self.handlers = {'Signal': {}}
-        self.handler_threads = []
+        # Called on the receive thread with every decoded event, before any routing. They
+        # have to be quick, and having any at all turns off deferred decoding, so most code
+        # should add a handler instead.
+        self.listeners = []
+
+        # Decoded image payloads, messages only hold a Blob handle to theirs
+        self.blobs = BlobStore()
+
+        self.metrics = ClientMetrics(self.dispatcher)
+
+        # Gets every raw line in both directions, e.g. a capture.CaptureWriter
+        self.recorder = None
+
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
 
         self.cmd = None
 
         self.cmd = VoyagerCommandWrapper(self)
+        self._commands = CommandTracker(self.cmd.get_remote_action_result)
+
+    @property
+    def log_length(self):
+        return self.logs.maxlen
+
+    @log_length.setter
+    def log_length(self, maxlen):
+        self.logs.resize(maxlen)
+
+    @property
+    def signals_length(self):
+        return self.signals.maxlen
+
+    @signals_length.setter
+    def signals_length(self, maxlen):
+        self.signals.resize(maxlen)
+
+    @property
+    def messages_length(self):
+        return self.messages.maxlen
+
+    @messages_length.setter
+    def messages_length(self, maxlen):
+        self.messages.resize(maxlen)
 
     def close(self):
-        self._shut_down.set()
         log.info("Waiting for threads to shut down")
-        while self._shut_down.is_set():
-            time.sleep(0.5)  # Wait for threads
+        self._shut_down.set()
+        if self._owns_dispatcher:
+            self.dispatcher.shutdown()
+        self._wake()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # Already signalled, or the pair is closed
 
     def _shut_down_handler(self):
-        if self._shut_down.is_set():
-            log.info("Closing out")
-            while self.handler_threads:
-                self._thread_cleanup()
-            self._send_message(self._encode_message({'method': 'disconnect', "id": self.client_id}))
+        log.info("Closing out")
+        if self._connected:
+            self._queue_message(self._encode_message({'method': 'disconnect', "id": self.client_id}))
+            with self._send_lock:
+                self.sock.settimeout(1)
+                try:
+                    self.sock.sendall(self._write_buffer)
+                    self.metrics.bytes_out += len(self._write_buffer)
+                except OSError as e:
+                    log.debug(repr(e))
+                self._write_buffer.clear()
+
+    def _open(self):
+        log.info("Connecting")
+        if self.sock.fileno() < 0:
+            self.sock = socket.socket()
+        self.sock.settimeout(self.connect_timeout)
+        try:
+            self.sock.connect((self.host, self.port))
+        except OSError:
             self.sock.close()
-            self._connected = False
-            self._shut_down.clear()
-            return True
+            raise
+        self.sock.setblocking(False)
+        # Writes are already batched in _flush, Nagle would only add delay on top
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._last_send = time.monotonic()
+
+    def _release(self):
+        self.sock.close()
+        self._connected = False
+        self._ready.clear()
+
+        # Nothing sent or half received carries over to the next connection, and commands
+        # still waiting for a result won't get one
+        with self._send_lock:
+            self._write_buffer.clear()
+        self._want_write = False
+        self._recv_buffer.clear()
+        self._scan_pos = 0
+        self._commands.fail_all(ConnectionError("Connection to Voyager lost"))
 
     def run(self):
-        log.info("Connecting")
-        self.sock.connect((self.host, self.port))
-        while True:
-            try:
-                data = self.sock.recv(1024).decode()
-                break
-            except socket.timeout:
-                pass
-        log.info(f"Version message: {data}")
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wake_r, selectors.EVENT_READ, 'wake')
 
-        while True:
-            if self._shut_down_handler():
-                break
-            self._connected = True
-            try:
-                data = b''
-                while True:
+        attempt = failures = 0
+        try:
+            while not self._shut_down.is_set():
+                try:
+                    self._open()
+                except OSError as e:
+                    if not self.reconnect:
+                        raise
+                    # Once per outage, not for every retry
+                    (log.debug if failures else log.warning)("Connecting to %s:%d failed: %r",
+                                                             self.host, self.port, e)
+                    failures += 1
+                else:
+                    attempt = failures = 0
+                    self._selector.register(self.sock, selectors.EVENT_READ, 'sock')
                     try:
-                        data_chunk = self.sock.recv(2048)
-                        log.debug(f"Main loop receive: {data_chunk}")
-                        data += data_chunk
-                    except socket.timeout:
-                        if not data:
-                            raise
-                        data = data.decode()
+                        self._serve()
+                    finally:
+                        self._selector.unregister(self.sock)
+                        self._release()
+                    if not self.reconnect:
                         break
-            except socket.timeout:
-                next
-            else:
-                if not data:
-                    log.info("Disconnect")
+
+                if not self._shut_down.is_set():
+                    self._shut_down.wait(self._backoff(attempt))
+                    attempt += 1
+        finally:
+            self._selector.close()
+
+    def _backoff(self, attempt):
+        """Seconds before connection attempt number attempt + 1, at most reconnect_max_delay"""
+        delay = min(self.reconnect_max_delay, self.reconnect_delay * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _serve(self):
+        """Run the connection until it drops or the client is closed"""
+        while not self._shut_down.is_set():
+            timeout = self._heartbeat()
+            self._flush()
+            for key, mask in self._selector.select(timeout):
+                if key.data == 'wake':
+                    self._drain_wake()
+                elif mask & selectors.EVENT_READ and not self._read_socket():
+                    return
+        self._shut_down_handler()
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read_socket(self):
+        try:
+            received = self.sock.recv_into(self._recv_chunk)
+        except (BlockingIOError, socket.timeout):
+            return True
+
+        if not received:
+            log.info("Disconnect")
+            return False
+
+        self.metrics.bytes_in += received
+        self._recv_buffer += self._recv_view[:received]
+        for line in self._pop_lines():
+            if not self._process_line(line):
+                return False
+        return True
+
+    def _pop_lines(self):
+        """Split every complete CRLF terminated line off the front of the receive buffer.
+
+        Only bytes that arrived since the last call are scanned for the terminator, so a
+        multi-megabyte frame spread over many reads costs linear time overall.
+        """
+        buf = self._recv_buffer
+        lines = []
+        start = 0
+        pos = self._scan_pos
+        # Slicing the view copies each line once, straight into its bytes. The view has to
+        # be released before the buffer can shrink.
+        with memoryview(buf) as view:
+            while True:
+                end = buf.find(b'\n', pos)
+                if end < 0:
                     break
+                if end > start:
+                    lines.append(bytes(view[start:end]))
+                start = pos = end + 1
+        if start:
+            del buf[:start]
+        self._scan_pos = len(buf)
+        return lines
+
+    def _process_line(self, line):
+        if self.recorder:
+            self.recorder.inbound(line)
+
+        event = peek_event(line)
+        self.metrics.events[event or 'other'] += 1
+        if event == 'ControlData':
+            self.cmd.cache.observe_control_data(line)
+        if event and self._can_defer(event) and len(line) <= LAZY_FIELD_MIN_SIZE:
+            # Nobody is listening, keep the raw line and decode it if it is ever read. Lines
+            # with a payload are decoded anyway, so the payload goes to the blob store.
+            self._add_message(line)
+            return True
 
-                for msg in data.splitlines():
-                    dcm = self._decode_message(msg)
-
-                    if dcm and not dcm.get('jsonrpc'):
-                        log.debug(f"Got: {dcm}".strip())
-
-                        event = dcm.get('Event', None)
-
-                        if event and event in self.heartbeat_events:
-                            self._send_heartbeat()
-                            if event not in ('Version', 'Polling'):
-                                self._handle_cmd(dcm)
-                        elif event == 'Signal':
-                            self._handle_signal(dcm)
-                        elif event == 'LogEvent':
-                            self._handle_log(dcm)
-                            self._send_heartbeat()
-                        elif event == 'ShutDown':
-                            log.warn('Received shutdown signa from host. Closing connection')
-                            self.sock.close()
-                            return
-                        else:
-                            self._handle_cmd(dcm)
-            self._thread_cleanup()
-
-    def add_handler(self, event_id, callback_func, signal=-1, *args, **kwargs):
+        started = time.perf_counter()
+        dcm = self._decode_message(line)
+        self.metrics.decode_seconds.observe(time.perf_counter() - started)
+
+        if dcm and not dcm.get('jsonrpc'):
+            log.debug("Got: %s", Brief(dcm))
+
+            event = dcm.get('Event', None)
+
+            for listener in self.listeners:
+                try:
+                    listener(dcm)
+                except Exception as e:
+                    log.error("Listener %s failed: %r", listener, e)
+
+            if event == 'Version':
+                log.info(f"Version message: {dcm}")
+                self._connected = True
+                if self._sessions:
+                    self._restore_session()
+                self._sessions += 1
+                self._ready.set()
+
+            if event and event in self.heartbeat_events:
+                if event not in ('Version', 'Polling'):
+                    self._handle_cmd(dcm)
+                else:
+                    self._dispatch(dcm)
+            elif event == 'Signal':
+                self._handle_signal(dcm)
+            elif event == 'LogEvent':
+                self._handle_log(dcm)
+            elif event == 'ShutDown':
+                self._dispatch(dcm)
+                log.warn('Received shutdown signa from host. Closing connection')
+                return False
+            else:
+                self._handle_cmd(dcm)
+        return True
+
+    def _restore_session(self):
+        """Send the session settings made on earlier connections again, all at once"""
+        self.cmd.cache.clear()
+        for command, params in list(self.cmd.session.items()):
+            log.info("Restoring %s", command)
+            pending = self.submit_command(command, dict(params))
+            pending.future.add_done_callback(functools.partial(self._check_restored, command))
+
+    def _check_restored(self, command, future):
+        if future.exception() is not None:
+            log.warning("Restoring %s failed: %r", command, future.exception())
+            return
+        result = future.result()['output'][-1]
+        if result.get('ActionResultInt') != 4:
+            log.warning("Restoring %s ended %s", command, result.get('ActionResult'))
+
+    def add_handler(self, event_id, callback_func, signal=-1, *args, queue_size=None, overflow=None, predicate=None,
+                    **kwargs):
+        """Register callback_func for event_id, returns its Handler.
+
+        event_id is an event name, '*' for every event or a pattern such as 'Remote*', and
+        any number of handlers can share one. For Signal, signal narrows it to a code, a
+        range or a set of codes, -1 takes them all. predicate, if given, is called with each
+        matching message and only those it returns true for are delivered.
+
+        Messages are queued per handler and delivered in order on the dispatcher's worker
+        pool. queue_size bounds that queue and overflow picks what happens when it is full:
+        'drop_oldest', the default unless handler_overflow says otherwise, discards the
+        oldest queued message and 'latest' keeps only the newest one. 'block' stalls the
+        receive loop instead, so it is only safe for handlers that never wait on a command.
+        """
         log.info(f"Adding handler for event_id: {event_id}, func: {callback_func}")
-        if event_id == 'Signal':
-            self.handlers['Signal'][signal] = Handler('Signal', callback_func, signal=signal, *args, **kwargs)
-        else:
-            self.handlers[event_id] = Handler(event_id, callback_func, *args, **kwargs)
+        if queue_size is None:
+            queue_size = self.handler_queue_size
+        if overflow is None:
+            overflow = self.handler_overflow.get(event_id, 'drop_oldest')
+
+        handler = Handler(event_id, callback_func, signal if event_id == 'Signal' else -1, *args,
+                          queue_size=queue_size, overflow=overflow, predicate=predicate, **kwargs)
+        return self.handlers.add(handler)
 
-    def remove_handler(self, event_id):
+    def remove_handler(self, event_id, handler=None):
+        """Remove handler, or every handler registered for event_id"""
         log.info(f"Removing handler for event_id: {event_id}")
-        del self.handlers[event_id]
+        if handler is not None:
+            removed = [handler] if self.handlers.remove(handler) else []
+        else:
+            removed = self.handlers.remove_event(event_id)
+        for handler in removed:
+            handler.mailbox.close()
+
+    def _dispatch(self, message):
+        """Queue message for every handler it matches, returns True if there was one"""
+        handlers = self.handlers.route(message)
+        for handler in handlers:
+            self.dispatcher.dispatch(handler, message)
+        return bool(handlers)
+
+    def _can_defer(self, event):
+        return (event not in ROUTED_EVENTS and event not in self.handlers
+                and not self.listeners and not self._commands.expects(event))
 
     def _add_message(self, message):
-        log.debug(f"Adding message: {message}")
-        if len(self.messages) >= self.messages_length:
-            log.debug(f"Message queue full, popped: {self.messages.pop()}")
+        log.debug("Adding message: %s", Brief(message))
         self.messages.append(message)
 
-    def _thread_cleanup(self):
-        for index, thread in enumerate(self.handler_threads):
-            if not thread.is_alive():
-                thread.join()
-                log.debug(f"Thread {thread.ident} for {thread.handler.handle} shut down")
-                del self.handler_threads[index]
+    def _message_event(self, message):
+        if isinstance(message, bytes):
+            return peek_event(message)
+        return message.get('Event')
+
+    def _decode_deferred(self, message):
+        # Lines nobody listened for are kept raw until someone reads them
+        if isinstance(message, bytes):
+            return self._decode_message(message)
+        return message
+
+    def _log_level(self, message):
+        level = self.cmd.get_log_level_text(message.get('Type'))
+        return level['level'] if level else None
 
     def _handle_signal(self, message):
         message['CodeMsg'] = self.cmd.get_signal(message['Code'])
-        log.debug(f"Adding signal: {message}")
-        if len(self.signals) >= self.signals_length:
-            log.debug(f"Signal queue full, popped: {self.signals.pop()}")
+        self.cmd.cache.observe_signal(message['Code'])
+        log.debug("Adding signal: %s", Brief(message))
         self.signals.append(message)
-
-        code = message.get('Code', '')
-        signal_handler = self.handlers['Signal'].get(code)
-        if signal_handler:
-            try:
-                handler_thread = HandlerThread(message, signal_handler)
-                handler_thread.start()
-                self.handler_threads.append(handler_thread)
-            except:
-                pass
-            finally:
-                return
+        self._dispatch(message)
 
     def _handle_log(self, message):
-        log.debug(f"Adding log: {message}")
-        if len(self.logs) >= self.log_length:
-            log.debug(f"Log queue full, popped: {self.logs.pop()}")
+        log.debug("Adding log: %s", Brief(message))
         self.logs.append(message)
+        self._dispatch(message)
 
     def _send_heartbeat(self):
         log.debug("Sending heartbeat")
         heartbeat_message = self._encode_message({'Event': 'Polling'})
-        self._send_message(heartbeat_message)
+        self._queue_message(heartbeat_message)
+
+    def _heartbeat(self):
+        """Queue a Polling if the link has been quiet, returns seconds until the next check"""
+        if not self._connected:
+            return self.heartbeat_interval
+        idle = time.monotonic() - self._last_send
+        if idle < self.heartbeat_interval:
+            return self.heartbeat_interval - idle
+        self._send_heartbeat()
+        return self.heartbeat_interval
 
     def _handle_cmd(self, message):
-        log.debug(f"_handle_cmd input: {message}")
-        event = message.get('Event', '')
-
-        cmd_handler = self.handlers.get(event)
-        if cmd_handler:
-            try:
-                handler_thread = HandlerThread(message, cmd_handler)
-                handler_thread.start()
-                self.handler_threads.append(handler_thread)
-            except:
-                pass
-            finally:
-                return
+        log.debug("_handle_cmd input: %s", Brief(message))
+        claimed = self._commands.claim(message)
 
-        if self.cmd_running:
-            cmd_result = self.cmd_running.lstrip('Remote')
-            cmd_result = cmd_result.lstrip('Get')
-        else:
-            cmd_result = ""
-
-        if event == 'RemoteActionResult' or (self.cmd_running and cmd_result == event):
-            self.cmd_assembly.append(message)
-            self.cmd_running = None
-        elif (self.cmd_running and cmd_result != event) or not self.cmd_running:
+        if not self._dispatch(message) and not claimed:
             self._add_message(message)
 
     def get_message(self):
-        if len(self.messages) == 0:
+        """Oldest message not yet returned by get_message(), without removing it"""
+        entry = self.messages.next_after(self._message_cursor)
+        if entry is None:
             return None
-        return self.messages.pop()
+        self._message_cursor, message = entry
+        return message
 
     def get_signal(self):
-        if len(self.signals) == 0:
+        """Oldest signal not yet returned by get_signal(), without removing it"""
+        entry = self.signals.next_after(self._signal_cursor)
+        if entry is None:
             return None
-        return self.signals.pop()
+        self._signal_cursor, signal = entry
+        return signal
+
+    def send_command(self, command, params=None, uid=None, timeout=None):
+        """Send command and block until its RemoteActionResult arrives.
 
-    def send_command(self, command, params=None, uid=None):
-        log.debug(f"send_command input: {command}, params: {params}")
-        while not self._connected:
-            time.sleep(0.5)
+        Replies are matched by UID, so any number of threads can have commands in flight at
+        once. Raises TimeoutError when no result arrives within timeout seconds, which
+        defaults to command_timeouts[command] and then command_timeout.
+        """
+        log.debug("send_command input: %s, params: %s", command, params)
+        if timeout is None:
+            timeout = self.command_timeouts.get(command, self.command_timeout)
+        deadline = time.monotonic() + timeout if timeout is not None else None
 
+        if not self._ready.wait(timeout):
+            raise TimeoutError(f"{command}: not connected to Voyager")
+
+        pending = self.submit_command(command, params, uid)
+        try:
+            return pending.future.result(None if deadline is None else max(0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            self._commands.forget(pending)
+            raise TimeoutError(f"{command}: no result for UID {pending.uid} after {timeout}s")
+
+    def submit_command(self, command, params=None, uid=None):
+        """Send command without waiting, returns its PendingCommand whose future gets the result"""
         if not params:
             params = {}
         if not uid:
@@ -244,48 +568,472 @@ class VoyagerClient(threading.Thread):
             params['UID'] = uid
         params['TimeoutConnect'] = 90
 
-        cmd_assembly = {'method': command, 'params': params, 'id': self.client_id}
-
-        encoded_msg = self._encode_message(cmd_assembly)
-        self.cmd_running = command
-        self._send_message(encoded_msg)
+        pending = self._commands.register(command, params['UID'])
 
-        while self.cmd_running:
-            time.sleep(0.5)
-
-        data_copy = list(self.cmd_assembly)
-        self.cmd_assembly.clear()
-        data_copy[-1]['ActionResult'] = self.cmd.get_remote_action_result(data_copy[-1]['ActionResultInt'])
-        return {'output': data_copy, 'uuid': params['UID']}
+        cmd_assembly = {'method': command, 'params': params, 'id': self.client_id}
+        self._send_message(self._encode_message(cmd_assembly))
+        return pending
 
     def _send_message(self, encoded_msg):
-        log.debug(f"Sending message: {encoded_msg}")
-        self.sock.sendall(encoded_msg)
+        if self._queue_message(encoded_msg):
+            self._wake()
+
+    def _queue_message(self, encoded_msg):
+        """Append to the write buffer, returns True if it was empty before"""
+        log.debug("Sending message: %s", Brief(encoded_msg))
+        if self.recorder:
+            self.recorder.outbound(encoded_msg)
+        with self._send_lock:
+            idle = not self._write_buffer
+            self._write_buffer += encoded_msg
+            return idle
+
+    def _flush(self):
+        """Write as much of the write buffer as the socket accepts in one send() call"""
+        with self._send_lock:
+            if self._write_buffer:
+                try:
+                    sent = self.sock.send(self._write_buffer)
+                except (BlockingIOError, socket.timeout):
+                    sent = 0
+                if sent:
+                    del self._write_buffer[:sent]
+                    self._last_send = time.monotonic()
+                    self.metrics.bytes_out += sent
+            backlog = bool(self._write_buffer)
+
+        # Only ask for writability while the kernel buffer is full
+        if backlog != self._want_write:
+            self._want_write = backlog
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if backlog else 0)
+            self._selector.modify(self.sock, events, self._selector.get_key(self.sock).data)
 
     def _decode_message(self, message):
-        log.debug(f"_decode_message input: {message}")
+        log.debug("_decode_message input: %s", Brief(message))
         try:
-            decoded_msg = json.loads(message.strip())
-            return decoded_msg
+            return decode_message(message, self.blobs)
         except Exception as e:
-            log.warn(f"Decode fail: {message}")
+            log.warning("Decode fail: %s", Brief(message))
             log.debug(repr(e))
             return None
 
     def _encode_message(self, message):
-        log.debug(f"_encode_message input: {message}")
+        log.debug("_encode_message input: %s", Brief(message))
         try:
             encoded_msg = json.dumps(message) + "\r\n"
             return encoded_msg.encode()
         except Exception as e:
-            log.warn(f"Encode fail: {message}")
+            log.warning("Encode fail: %s", Brief(message))
             log.debug(repr(e))
             return None
 
 
+class VoyagerMultiplexer(threading.Thread):
+    """Drives many VoyagerClient sessions from one selector thread.
+
+    Each host gets an ordinary VoyagerClient with its own handlers and commands, but none
+    of them runs its own thread: this loop reads all of their sockets and every handler
+    runs on one shared dispatcher pool. Events from every host are also merged into a
+    single stream of (name, message) tuples.
+
+        mux = VoyagerMultiplexer()
+        mux.start()
+        north = mux.add_host('north', '172.16.50.50', 5950)
+        north.add_handler('ControlData', handle_control_data)
+        for name, message in mux.iter_events():
+            ...
+    """
+    def __init__(self, handler_workers=4, stream_size=1000, name=None):
+        super(VoyagerMultiplexer, self).__init__(name=name, daemon=True)
+        self.clients = {}
+        self.dispatcher = Dispatcher(workers=handler_workers)
+
+        # Merged event stream, 0 turns it off
+        self.stream_size = stream_size
+        self.events = queue.Queue(stream_size)
+
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, ('wake', None))
+
+        self._attach = collections.deque()
+        self._shut_down = threading.Event()
+
+    def __getitem__(self, name):
+        return self.clients[name]
+
+    def add_host(self, name, host, port, client_id=None):
+        """Connect to a Voyager host and start serving it from the multiplexer loop"""
+        if name in self.clients:
+            raise ValueError(f"Host already added: {name}")
+
+        client = VoyagerClient(host, port, client_id=client_id, dispatcher=self.dispatcher, name=name)
+        if self.stream_size:
+            client.listeners.append(functools.partial(self._publish, name))
+        client._open()
+
+        self.clients[name] = client
+        self._attach.append(client)
+        self._wake()
+        return client
+
+    def remove_host(self, name):
+        self.clients[name].close()
+
+    def iter_events(self, timeout=None):
+        """Yield (name, message) from every host, stops once timeout passes without one"""
+        while True:
+            try:
+                yield self.events.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+    def _publish(self, name, message):
+        while True:
+            try:
+                self.events.put_nowait((name, message))
+                return
+            except queue.Full:
+                try:
+                    self.events.get_nowait()  # Nobody is keeping up, drop the oldest
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        log.info("Closing multiplexer")
+        self._shut_down.set()
+        self._wake()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        self.dispatcher.shutdown()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        try:
+            while not self._shut_down.is_set():
+                while self._attach:
+                    client = self._attach.popleft()
+                    client._selector = self._selector
+                    self._selector.register(client.sock, selectors.EVENT_READ, ('sock', client))
+                    self._selector.register(client._wake_r, selectors.EVENT_READ, ('wake', client))
+
+                timeout = None
+                for client in list(self.clients.values()):
+                    if client._selector is not self._selector:
+                        continue  # Not attached yet
+                    client_timeout = client._heartbeat()
+                    client._flush()
+                    timeout = client_timeout if timeout is None else min(timeout, client_timeout)
+
+                for key, mask in self._selector.select(timeout):
+                    kind, client = key.data
+                    if client is None:
+                        self._drain_wake()
+                    elif client._selector is not self._selector:
+                        continue  # Detached by an earlier key of this batch
+                    elif kind == 'wake':
+                        client._drain_wake()
+                        if client._shut_down.is_set():
+                            self._detach(client)
+                    elif mask & selectors.EVENT_READ and not client._read_socket():
+                        self._detach(client)
+
+            for client in list(self.clients.values()):
+                client._shut_down.set()
+                self._detach(client)
+        finally:
+            self._selector.close()
+
+    def _detach(self, client):
+        if client._selector is not self._selector:
+            return  # Already detached
+        client._selector = None
+        self._selector.unregister(client.sock)
+        self._selector.unregister(client._wake_r)
+        if client._shut_down.is_set():
+            client._shut_down_handler()
+        client._release()
+        self.clients.pop(client.name, None)
+
+
+class AsyncVoyagerClient(object):
+    """asyncio implementation of the Voyager protocol.
+
+    Everything runs on the event loop: commands are awaitable, and events are consumed
+    with async iterators instead of handler threads.
+
+        async with AsyncVoyagerClient(host, port) as client:
+            await client.cmd.set_dashboard('enable')
+            async for message in client.subscribe('ControlData'):
+                ...
+    """
+    def __init__(self, host, port, client_id=None, heartbeat_interval=5):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+
+        if not self.client_id:
+            self.client_id = random.randrange(1, 10)
+
+        self.heartbeat_interval = heartbeat_interval
+        self.command_timeout = None
+        self.command_timeouts = dict(VoyagerClient.command_timeouts_default)
+
+        # Image frames are single lines of several megabytes
+        self.line_limit = 64 * 1024 * 1024
+
+        self.metrics = ClientMetrics()
+        self.blobs = BlobStore()
+
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+        self._ready = None
+        self._subscriptions = collections.defaultdict(list)
+
+        self.cmd = VoyagerCommandWrapper(self)
+        self._commands = CommandTracker(self.cmd.get_remote_action_result)
+
+    _decode_message = VoyagerClient._decode_message
+    _encode_message = VoyagerClient._encode_message
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        log.info("Connecting")
+        self._ready = asyncio.Event()
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port, limit=self.line_limit)
+        self._tasks = [asyncio.create_task(self._read_loop()),
+                       asyncio.create_task(self._heartbeat_loop())]
+        await self._ready.wait()
+
+    async def close(self):
+        log.info("Closing out")
+        if self._writer and not self._writer.is_closing():
+            self._send_message(self._encode_message({'method': 'disconnect', "id": self.client_id}))
+            self._writer.close()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._end_subscriptions()
+
+    def subscribe(self, event_id, maxsize=100, predicate=None):
+        """Async iterator over every event_id message, '*' subscribes to all events.
+
+        A subscription stays registered until it is closed, so one left early with break
+        should be used as a context manager or closed with aclose():
+
+            async with client.subscribe('NewJPGReady') as frames:
+                async for message in frames:
+                    ...
+        """
+        subscription = Subscription(self, event_id, maxsize, predicate)
+        self._subscriptions[event_id].append(subscription)
+        return subscription
+
+    def signals(self, code=None, maxsize=100):
+        predicate = None if code is None else (lambda message: message.get('Code') == code)
+        return self.subscribe('Signal', maxsize, predicate)
+
+    def logs(self, maxsize=1000):
+        return self.subscribe('LogEvent', maxsize)
+
+    def _unsubscribe(self, subscription):
+        subscriptions = self._subscriptions.get(subscription.event_id)
+        if subscriptions and subscription in subscriptions:
+            subscriptions.remove(subscription)
+        if not subscriptions:
+            # An empty entry would keep _process_line decoding the event for nobody
+            self._subscriptions.pop(subscription.event_id, None)
+
+    def _end_subscriptions(self):
+        for subscriptions in list(self._subscriptions.values()):
+            for subscription in list(subscriptions):
+                subscription.close()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                try:
+                    line = await self._reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError:
+                    log.info("Disconnect")
+                    break
+                self.metrics.bytes_in += len(line)
+                self._process_line(line)
+        finally:
+            self._commands.fail_all(ConnectionError("Connection to Voyager lost"))
+            self._end_subscriptions()
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            self._send_message(self._encode_message({'Event': 'Polling'}))
+
+    def _process_line(self, line):
+        event = peek_event(line)
+        self.metrics.events[event or 'other'] += 1
+        if event == 'ControlData':
+            self.cmd.cache.observe_control_data(line)
+        if (event and event not in ROUTED_EVENTS and event not in self._subscriptions
+                and '*' not in self._subscriptions and not self._commands.expects(event)):
+            return
+
+        started = time.perf_counter()
+        message = self._decode_message(line)
+        self.metrics.decode_seconds.observe(time.perf_counter() - started)
+        if not message or message.get('jsonrpc'):
+            return
+
+        event = message.get('Event')
+        if event == 'Version':
+            log.info(f"Version message: {message}")
+            self._ready.set()
+        elif event == 'Signal':
+            message['CodeMsg'] = self.cmd.get_signal(message.get('Code'))
+            self.cmd.cache.observe_signal(message.get('Code'))
+        elif event == 'ShutDown':
+            log.warning('Received shutdown signal from host. Closing connection')
+            self._writer.close()
+            return
+        elif event not in ('Polling', 'LogEvent'):
+            self._commands.claim(message)
+
+        for key in (event, '*'):
+            for subscription in self._subscriptions.get(key, ()):
+                subscription.put(message)
+
+    async def send_command(self, command, params=None, uid=None, timeout=None):
+        log.debug("send_command input: %s, params: %s", command, params)
+        if timeout is None:
+            timeout = self.command_timeouts.get(command, self.command_timeout)
+
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"{command}: not connected to Voyager")
+
+        pending = self.submit_command(command, params, uid)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(pending.future), timeout)
+        except asyncio.TimeoutError:
+            self._commands.forget(pending)
+            raise TimeoutError(f"{command}: no result for UID {pending.uid} after {timeout}s")
+
+    def submit_command(self, command, params=None, uid=None):
+        """Send command without waiting, returns its PendingCommand whose future gets the result"""
+        if not params:
+            params = {}
+        params['UID'] = uid or str(uuid.uuid4())
+        params['TimeoutConnect'] = 90
+
+        pending = self._commands.register(command, params['UID'])
+        self._send_message(self._encode_message({'method': command, 'params': params, 'id': self.client_id}))
+        return pending
+
+    def _send_message(self, encoded_msg):
+        log.debug("Sending message: %s", Brief(encoded_msg))
+        self.metrics.bytes_out += len(encoded_msg)
+        self._writer.write(encoded_msg)
+
+
+class Subscription(object):
+    """Bounded async iterator of messages, drops the oldest message when the consumer lags"""
+    def __init__(self, client, event_id, maxsize=100, predicate=None):
+        self.event_id = event_id
+        self.predicate = predicate
+        self.dropped = 0
+
+        self._client = client
+        self._queue = asyncio.Queue(maxsize)
+        self._closed = False
+
+    def put(self, message):
+        if self._closed or (self.predicate and not self.predicate(message)):
+            return
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(message)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._client._unsubscribe(self)
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    async def aclose(self):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed and self._queue.empty():
+            raise StopAsyncIteration
+        message = await self._queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+
 class VoyagerCommandWrapper(object):
+    # Seconds the answer of a read-only query is reused for, 0 always asks Voyager
+    cache_ttls_default = {
+        'RemoteGetFilterConfiguration': 300,
+        'GetArrayElementData': 60,
+        'RemoteFilterGetActual': 30,
+        'RemoteGetCCDTemperature': 5
+    }
+
+    # Commands that change what the cached queries would answer, the cache is cleared as
+    # they are sent and again once they are done
+    invalidating_commands = frozenset(('RemoteSetupConnect', 'RemoteSetupDisconnect', 'RemoteSetProfile'))
+
+    # ControlData fields answering get_ccd_temp, by their RemoteGetCCDTemperature ParamRet name
+    ccd_temperature_fields = {
+        'CCDTEMP': 'CCDTemp',
+        'CCDPOW': 'CCDPower',
+        'CCDSETP': 'CCDSetPoint',
+        'CCDSTAT': 'CCDStatus'
+    }
+
     def __init__(self, client):
         self._client = client
+        self._async = asyncio.iscoroutinefunction(client.send_command)
+        self.cache = ResponseCache(self.cache_ttls_default)
+
+        # Settings Voyager keeps per connection, by command, sent again after a reconnect
+        self.session = collections.OrderedDict()
 
         self.signal_list = {
             1: 'Autofocus Error',
@@ -374,35 +1122,88 @@ class VoyagerCommandWrapper(object):
             return
 
         struct = {'IsOn': True if action == 'enable' else False, 'Level': level}
-        return self._client.send_command('RemoteSetLogEvent', struct)
+        self.session['RemoteSetLogEvent'] = struct
+        return self._client.send_command('RemoteSetLogEvent', dict(struct))
 
     def set_dashboard(self, action=None):
         if not action or action not in ['enable', 'disable']:
             return
 
         struct = {'IsOn': True if action == 'enable' else False}
-        return self._client.send_command('RemoteSetDashboardMode', struct)
+        self.session['RemoteSetDashboardMode'] = struct
+        return self._client.send_command('RemoteSetDashboardMode', dict(struct))
+
+    def pipeline(self, sequential=False, timeout=None):
+        """A CommandPipeline on this client, see there"""
+        return CommandPipeline(self._client, sequential, timeout)
+
+    def _query(self, command):
+        """send_command for a read-only command, answered from the cache where possible"""
+        send = functools.partial(self._client.send_command, command)
+        if self._async:
+            return self.cache.call_async(command, send)
+        return self.cache.call(command, send)
+
+    def _invalidating(self, command, params=None):
+        """send_command for a command that changes what the cached queries would answer"""
+        self.cache.clear()
+        result = self._client.send_command(command, params)
+        if not self._async:
+            self.cache.clear()
+            return result
+
+        async def finish():
+            try:
+                return await result
+            finally:
+                self.cache.clear()
+        return finish()
 
     def get_array_element_data(self):
-        return self._client.send_command('GetArrayElementData')
+        return self._query('GetArrayElementData')
 
     def abort_action(self, uid):
-        return self._client.send_command('RemoteActionAbort', uid=uuid)
+        return self._client.send_command('RemoteActionAbort', uid=uid)
 
     def get_filter(self):
-        return self._client.send_command('RemoteFilterGetActual')
+        return self._query('RemoteFilterGetActual')
 
     def get_filter_configuration(self):
-        return self._client.send_command('RemoteGetFilterConfiguration')
+        return self._query('RemoteGetFilterConfiguration')
 
     def get_ccd_temp(self):
-        return self._client.send_command('RemoteGetCCDTemperature')
+        """Result of RemoteGetCCDTemperature. ControlData carries the same readings, so if one
+        arrived within the command's cache TTL the answer is made from it instead: a
+        successful RemoteActionResult with them in ParamRet and no UID.
+        """
+        control_data = self.cache.control_data(self.cache.ttls.get('RemoteGetCCDTemperature', 0))
+        if control_data is None:
+            return self._query('RemoteGetCCDTemperature')
+
+        answer = {
+            'Event': 'RemoteActionResult',
+            'Timestamp': control_data.get('Timestamp'),
+            'Host': control_data.get('Host'),
+            'Inst': control_data.get('Inst'),
+            'UID': None,
+            'ActionResultInt': 4,
+            'ActionResult': self.get_remote_action_result(4),
+            'Motivo': '',
+            'ParamRet': {name: control_data.get(field) for field, name in self.ccd_temperature_fields.items()}
+        }
+        result = {'output': [answer], 'uuid': None}
+        if not self._async:
+            return result
+
+        async def cached():
+            return result
+        return cached()
 
     def disconnect_setup(self):
-        return self._client.send_command('RemoteSetupDisconnect')
+        return self._invalidating('RemoteSetupDisconnect')
 
     def connect_setup(self):
-        return self._client.send_command('RemoteSetupConnect')
+        return self._invalidating('RemoteSetupConnect')
 
     def precise_point_target(self,
                              ra=0,
@@ -443,44 +1244,1101 @@ class VoyagerCommandWrapper(object):
         return self._client.send_command('RemoteMountFastCommand', struct)
 
     def set_profile(self, profile_filename):
-        return self._client.send_command('RemoteSetProfile', {'FileName': profile_filename})
+        return self._invalidating('RemoteSetProfile', {'FileName': profile_filename})
+
+
+class VoyagerMessage(dict):
+    """A decoded message whose large string fields are still raw bytes, or Blob handles.
+
+    Lazy fields are decoded to str on first access through [], get() or in. They are not
+    part of keys(), iteration or len() until then; raw() returns the undecoded bytes,
+    which base64 and file writes accept without building the str at all. blob() returns
+    the handle to a payload that went to a BlobStore, which is the cheapest way to it.
+    A payload the store has dropped reads as a missing field.
+    """
+    __slots__ = ('_lazy',)
+
+    def __init__(self, fields, lazy):
+        super(VoyagerMessage, self).__init__(fields)
+        self._lazy = lazy
+
+    def __missing__(self, key):
+        lazy = self._lazy[key]
+        if isinstance(lazy, Blob):
+            encoded = lazy.base64()
+            if encoded is None:
+                raise KeyError(key)  # Dropped by the store, as if the field wasn't there
+            # The handle stays, for blob()
+            value = str(encoded, 'ascii')
+        else:
+            value = str(self._lazy.pop(key), 'utf-8')
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        lazy = self._lazy.get(key)
+        return lazy is not None and (not isinstance(lazy, Blob) or lazy.available)
+
+    def __repr__(self):
+        lazy = ', '.join(f"{key!r}: <{len(raw)} bytes>" for key, raw in self._lazy.items()
+                         if not dict.__contains__(self, key))
+        return dict.__repr__(self)[:-1] + (', ' if len(self) and lazy else '') + lazy + '}'
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def raw(self, key):
+        """Field value as bytes-like, without decoding it to str"""
+        lazy = self._lazy.get(key)
+        if isinstance(lazy, Blob):
+            encoded = lazy.base64()
+            if encoded is None:
+                raise KeyError(key)
+            return encoded
+        if lazy is not None:
+            return lazy
+        return self[key].encode()
+
+    def blob(self, key):
+        """Blob handle of key, or None if the field didn't go to a BlobStore"""
+        lazy = self._lazy.get(key)
+        return lazy if isinstance(lazy, Blob) else None
+
+
+class Blob(object):
+    """A decoded payload in a BlobStore.
+
+    view() is the payload without a copy, from memory or from its spill file through mmap,
+    and None once the store has dropped it to stay within its budget.
+    """
+    __slots__ = ('size', '_data', '_path', '__weakref__')
+
+    def __init__(self, data):
+        self.size = len(data)
+        self._data = data
+        self._path = None
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        state = 'spilled' if self._path else ('in memory' if self._data is not None else 'dropped')
+        return f"<Blob {self.size} bytes, {state}>"
+
+    @property
+    def available(self):
+        return self._data is not None
+
+    def view(self):
+        data = self._data
+        return memoryview(data) if data is not None else None
+
+    def bytes(self):
+        """A copy of the payload, for APIs that want bytes"""
+        view = self.view()
+        return view.tobytes() if view is not None else None
+
+    def base64(self):
+        view = self.view()
+        return binascii.b2a_base64(view, newline=False) if view is not None else None
+
+    def write_to(self, file):
+        """Write the payload to a binary file object, returns False if it was dropped"""
+        view = self.view()
+        if view is None:
+            return False
+        file.write(view)
+        return True
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            return self.write_to(file)
+
+
+class BlobStore(object):
+    """Decoded payloads of large message fields, within a memory budget.
+
+    Payloads are decoded straight from the receive buffer into one bytes object each, and
+    their messages carry a Blob handle. A payload is freed with the last handle to it. When
+    those still held come to more than budget bytes, the oldest are written to spill_dir and
+    mapped back from there, or without a spill_dir dropped.
+    """
+    def __init__(self, budget=64 * 1024 * 1024, spill_dir=None):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.size = 0
+        self.spilled = 0
+        self.dropped = 0
+
+        self._resident = collections.OrderedDict()
+        self._seq = 0
+        # Reentrant, a handle can be collected and released while add() holds it
+        self._lock = threading.RLock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._resident)
+
+    def add(self, encoded):
+        """Blob of a base64 bytes-like value, decoded without an intermediate copy"""
+        blob = Blob(binascii.a2b_base64(encoded))
+        with self._lock:
+            self._seq += 1
+            key = self._seq
+            self._resident[key] = weakref.ref(blob, functools.partial(self._release, key, blob.size))
+            self.size += blob.size
+            while self.size > self.budget and len(self._resident) > 1:
+                self._evict()
+        return blob
+
+    def _release(self, key, size, _):
+        with self._lock:
+            if self._resident.pop(key, None) is not None:
+                self.size -= size
+
+    def _evict(self):
+        key, ref = self._resident.popitem(last=False)
+        blob = ref()
+        if blob is None:
+            return
+        self.size -= blob.size
+        if not self.spill_dir:
+            blob._data = None
+            self.dropped += 1
+            return
+
+        path = os.path.join(self.spill_dir, f"{os.getpid()}-{key}.blob")
+        with open(path, 'wb') as file:
+            file.write(blob._data)
+        with open(path, 'rb') as file:
+            blob._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if blob.size else b''
+        blob._path = path
+        weakref.finalize(blob, _unlink, path)
+        self.spilled += 1
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def peek_event(line):
+    """Event name of a raw message line, or None when it is not near the start"""
+    match = EVENT_PATTERN.search(line, 0, EVENT_PEEK_SIZE)
+    return match.group(1).decode() if match else None
+
+
+def decode_message(line, blobs=None):
+    """Parse one message line, splitting large string fields off as lazy bytes, or as
+    Blob handles when given a BlobStore
+    """
+    lazy = None
+    if len(line) > LAZY_FIELD_MIN_SIZE:
+        for name, pattern in LAZY_FIELDS.items():
+            match = pattern.search(line)
+            if not match:
+                continue
+            start = match.end()
+            end = line.find(b'"', start)
+            # Escaped values are rare and left to the JSON parser
+            if end - start < LAZY_FIELD_MIN_SIZE or line.find(b'\\', start, end) >= 0:
+                continue
+            if lazy is None:
+                lazy = {}
+            value = memoryview(line)[start:end]
+            lazy[name.decode()] = blobs.add(value) if blobs is not None else value
+            line = line[:start] + line[end:]
+
+    message = json_loads(line)
+    if lazy and isinstance(message, dict):
+        for name in lazy:
+            message.pop(name, None)
+        return VoyagerMessage(message, lazy)
+    return message
+
+
+class PendingCommand(object):
+    def __init__(self, command, uid):
+        self.command = command
+        self.uid = uid
+        # Data-returning commands may answer with an event named after the command,
+        # e.g. RemoteGetCCDTemperature -> CCDTemperature, ahead of the RemoteActionResult
+        self.reply_event = command.removeprefix('Remote').removeprefix('Get')
+        self.output = []
+        self.future = concurrent.futures.Future()
+
+
+class CommandTracker(object):
+    """In-flight commands keyed by UID, shared by the threaded and asyncio clients"""
+    def __init__(self, action_result_text):
+        self._action_result_text = action_result_text
+
+        # Commands by UID, plus the ones that expect a reply event by its name
+        self._pending = {}
+        self._by_event = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def register(self, command, uid):
+        with self._lock:
+            pending = self._pending.get(uid)
+            if pending is None:
+                # Commands like RemoteActionAbort reuse the UID of the action they target;
+                # those share the target's future rather than replacing it.
+                pending = PendingCommand(command, uid)
+                self._pending[uid] = pending
+                self._by_event[pending.reply_event].append(pending)
+            return pending
+
+    def claim(self, message):
+        """Attach message to the in-flight command it answers, returns True if it did"""
+        event = message.get('Event', '')
+        with self._lock:
+            pending = self._pending.get(message.get('UID'))
+            if not pending:
+                waiting = self._by_event.get(event)
+                if not waiting:
+                    return False
+                pending = waiting[0]
+
+            pending.output.append(message)
+            if event == 'RemoteActionResult':
+                self._forget(pending)
+                message['ActionResult'] = self._action_result_text(message.get('ActionResultInt'))
+                pending.future.set_result({'output': pending.output, 'uuid': pending.uid})
+            return True
+
+    def fail_all(self, exception):
+        """End every in-flight command with exception, e.g. when the connection is gone"""
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self._by_event.clear()
+        for command in pending:
+            if not command.future.done():
+                command.future.set_exception(exception)
+
+    def expects(self, event):
+        """True if event may be the reply to an in-flight command"""
+        return event in self._by_event or (event == 'RemoteActionResult' and bool(self._pending))
+
+    def forget(self, pending):
+        with self._lock:
+            self._forget(pending)
+
+    def _forget(self, pending):
+        self._pending.pop(pending.uid, None)
+        waiting = self._by_event.get(pending.reply_event)
+        if waiting:
+            try:
+                waiting.remove(pending)
+            except ValueError:
+                pass
+            if not waiting:
+                del self._by_event[pending.reply_event]
+
+
+class _CacheEntry(object):
+    def __init__(self, future):
+        self.future = future
+        self.expires = None
+
+
+class ResponseCache(object):
+    """Answers of read-only commands, reused for ttls[command] seconds.
+
+    A caller asking while the same command is already in flight waits for that one instead
+    of sending another, and a failed command is never cached. Signals that change what the
+    answers would be drop them: a filter change drops RemoteFilterGetActual, a setup
+    connect or disconnect drops everything. Answers are shared, treat them as read-only.
+    """
+    # Signal codes and the commands they make stale, None for all of them
+    invalidated_by = {
+        8: None,
+        9: None,
+        10: ('RemoteFilterGetActual',),
+        15: None,
+        16: None,
+        24: ('RemoteFilterGetActual',)
+    }
+
+    def __init__(self, ttls):
+        self.ttls = dict(ttls)
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = {}
+        self._control_data = None
+        self._lock = threading.Lock()
+
+    def _lookup(self, command, new_future):
+        """(future, True if the caller has to run the command)"""
+        with self._lock:
+            entry = self._entries.get(command)
+            if entry and (entry.expires is None or entry.expires > time.monotonic()):
+                self.hits += 1
+                return entry.future, False
+            self.misses += 1
+            entry = self._entries[command] = _CacheEntry(new_future())
+            return entry.future, True
+
+    def _settle(self, command, future, failed):
+        with self._lock:
+            entry = self._entries.get(command)
+            # Invalidated while in flight, its waiters still get the answer
+            if entry is None or entry.future is not future:
+                return
+            if failed:
+                del self._entries[command]
+            else:
+                entry.expires = time.monotonic() + self.ttls.get(command, 0)
+
+    def call(self, command, send):
+        """send() when command has no fresh or in-flight answer, otherwise that answer"""
+        if not self.ttls.get(command):
+            return send()
+        future, owner = self._lookup(command, concurrent.futures.Future)
+        if owner:
+            try:
+                future.set_result(send())
+            except BaseException as e:
+                future.set_exception(e)
+            self._settle(command, future, future.exception() is not None)
+        return future.result()
+
+    async def call_async(self, command, send):
+        """call() for coroutine functions, the command runs as a task the callers share"""
+        if not self.ttls.get(command):
+            return await send()
+        task, owner = self._lookup(command, lambda: asyncio.ensure_future(send()))
+        if owner:
+            task.add_done_callback(
+                lambda done: self._settle(command, done, done.cancelled() or done.exception() is not None))
+        return await asyncio.shield(task)
+
+    def invalidate(self, *commands):
+        with self._lock:
+            for command in commands:
+                self._entries.pop(command, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def observe_signal(self, code):
+        if code not in self.invalidated_by:
+            return
+        commands = self.invalidated_by[code]
+        if commands is None:
+            self.clear()
+        else:
+            self.invalidate(*commands)
+
+    def observe_control_data(self, line):
+        # Kept raw, it is only decoded if a query asks for it
+        self._control_data = (time.monotonic(), line)
+
+    def control_data(self, max_age):
+        """Latest ControlData if it arrived within max_age seconds, else None"""
+        latest = self._control_data
+        if not max_age or latest is None or time.monotonic() - latest[0] > max_age:
+            return None
+        message = latest[1]
+        return decode_message(message) if isinstance(message, (bytes, bytearray)) else message
+
+
+class _CommandRecorder(object):
+    """Stands in for a client, so wrapper methods return the command they would send"""
+    def send_command(self, command, params=None, uid=None, timeout=None):
+        return command, params, uid
+
+
+class PipelineStep(object):
+    def __init__(self, name, command, params, uid, after):
+        self.name = name
+        self.command = command
+        self.params = params
+        self.uid = uid
+        self.after = after
+
+        # ActionResult text once done, or SKIPPED, TIMEOUT, ERROR
+        self.status = None
+        self.ok = False
+        self.result = None
+        self.pending = None
+        self.future = None
+
+    def as_dict(self):
+        return {'name': self.name, 'command': self.command, 'uuid': self.uid, 'status': self.status,
+                'result': self.result}
+
+
+class CommandPipeline(object):
+    """Runs a chain of commands, sending every step whose dependencies are done back to back.
+
+    A step is a VoyagerCommandWrapper method and its arguments, or a raw command and its
+    params, and only waits for the steps given as after (for the step before it when
+    sequential). A step whose RemoteActionResult is not in ok_results fails the run:
+    nothing further is sent and steps still running are aborted with abort_action.
+    abort() does the same from another thread. run() returns every step's outcome, and
+    with an AsyncVoyagerClient it is a coroutine.
+
+        pipeline = client.cmd.pipeline()
+        setup = pipeline.add('connect_setup')
+        pipeline.add('set_dashboard', 'enable', after=setup)
+        pipeline.add('set_logs', 'enable', after=setup)
+        unpark = pipeline.add('mount_action', 'unpark', after=setup)
+        pipeline.add('precise_point_target', ra_text='00:42:44', dec_text='+41:16:09', after=unpark)
+        result = pipeline.run()
+    """
+    # OK and OK PARTIAL
+    ok_results = frozenset((4, 10))
+
+    def __init__(self, client, sequential=False, timeout=None):
+        self.sequential = sequential
+        self.timeout = timeout
+        self.steps = []
+        self.failed = None
+        self.aborted = False
+
+        self._client = client
+        self._recorder = VoyagerCommandWrapper(_CommandRecorder())
+        self._recorder.cache.ttls = {}
+        self._recorder.session = client.cmd.session
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def add(self, step, *args, after=None, **kwargs):
+        """Queue step: a wrapper method name such as 'mount_action' with its arguments, or a
+        command name such as 'RemoteSetupConnect' with its params. Returns the step, for after.
+        """
+        method = None if step.startswith('_') else getattr(self._recorder, step, None)
+        if callable(method):
+            recorded = method(*args, **kwargs)
+            if not isinstance(recorded, tuple):
+                raise ValueError(f"{step}{args}: not a command")
+            command, params, uid = recorded
+        else:
+            command, params, uid = step, (args[0] if args else kwargs.get('params')), None
+
+        if after is None:
+            after = [self.steps[-1]] if self.sequential and self.steps else []
+        elif isinstance(after, PipelineStep):
+            after = [after]
+        step = PipelineStep(step, command, params, uid, list(after))
+        self.steps.append(step)
+        return step
+
+    def run(self, timeout=None):
+        """Send the steps and wait for them, at most timeout seconds in total"""
+        timeout = timeout if timeout is not None else self.timeout
+        if asyncio.iscoroutinefunction(self._client.send_command):
+            return self._run_async(timeout)
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if not self._client._ready.wait(timeout):
+            raise TimeoutError("pipeline: not connected to Voyager")
+        while True:
+            self._send_ready(lambda future: future)
+            if not self._running:
+                break
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            done, _ = concurrent.futures.wait(self._running, remaining, concurrent.futures.FIRST_COMPLETED)
+            self._collect(done)
+        return self._summary()
+
+    async def _run_async(self, timeout):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            await asyncio.wait_for(self._client._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("pipeline: not connected to Voyager")
+        while True:
+            self._send_ready(asyncio.wrap_future)
+            if not self._running:
+                break
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            done, _ = await asyncio.wait(self._running, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            self._collect(done)
+        return self._summary()
+
+    def _send_ready(self, wrap):
+        """Send every step whose dependencies are done, all of them before waiting on any"""
+        with self._lock:
+            if self.failed or self.aborted:
+                return
+            for step in self.steps:
+                if step.status or step.future or not all(dep.ok for dep in step.after):
+                    continue
+                try:
+                    pending = self._client.submit_command(step.command, dict(step.params or {}), step.uid)
+                except Exception as e:
+                    step.status = 'ERROR'
+                    step.result = repr(e)
+                    self._fail(step)
+                    return
+                self._invalidate(step)
+                step.uid = pending.uid
+                step.pending = pending
+                step.future = wrap(pending.future)
+                self._running[step.future] = step
+
+    def _invalidate(self, step):
+        # Steps only went through the recorder, so the client's own cache is cleared here
+        if step.command in self._client.cmd.invalidating_commands:
+            self._client.cmd.cache.clear()
+
+    def _collect(self, done):
+        with self._lock:
+            if not done:
+                # Out of time, whatever is still running is aborted and given up on. Aborts
+                # share the step's UID, so they go out while it is still registered.
+                for step in self._running.values():
+                    step.status = 'TIMEOUT'
+                self._fail(next(iter(self._running.values())))
+                for step in self._running.values():
+                    self._client._commands.forget(step.pending)
+                self._running.clear()
+                return
+
+            for future in done:
+                step = self._running.pop(future)
+                self._invalidate(step)
+                if future.cancelled() or future.exception() is not None:
+                    step.status = 'ERROR'
+                    step.result = 'cancelled' if future.cancelled() else repr(future.exception())
+                else:
+                    step.result = future.result()
+                    last = step.result['output'][-1]
+                    step.status = last.get('ActionResult') or str(last.get('ActionResultInt'))
+                    step.ok = last.get('ActionResultInt') in self.ok_results
+                if not step.ok and not self.failed:
+                    self._fail(step)
+
+    def _fail(self, step):
+        log.warning("Pipeline step %s (%s) ended %s", step.name, step.command, step.status)
+        self.failed = step
+        self._abort_running()
+
+    def abort(self):
+        """Stop sending steps and abort the ones that are running"""
+        with self._lock:
+            self.aborted = True
+            self._abort_running()
+
+    def _abort_running(self):
+        for step in self._running.values():
+            command, params, uid = self._recorder.abort_action(step.uid)
+            try:
+                # Aborts reuse the step's UID, so the step's own future gets the outcome
+                self._client.submit_command(command, params, uid)
+            except Exception as e:
+                log.warning("Could not abort %s: %r", step.name, e)
+
+    def _summary(self):
+        for step in self.steps:
+            if not step.status:
+                step.status = 'SKIPPED'
+        return {
+            'ok': not self.aborted and all(step.ok for step in self.steps),
+            'failed': self.failed.name if self.failed else None,
+            'aborted': self.aborted,
+            'steps': [step.as_dict() for step in self.steps]
+        }
 
 
 class Handler(object):
-    def __init__(self, handle, callback_func, signal=-1, *args, **kwargs):
+    def __init__(self, handle, callback_func, signal=-1, *args, queue_size=100, overflow='drop_oldest',
+                 predicate=None, **kwargs):
         self.handle = handle
         self.callback_func = callback_func
         self.signal = signal
+        self.predicate = predicate
         self.args = args
         self.kwargs = kwargs
 
-        log.error(self.__dict__)
+        self.mailbox = Mailbox(queue_size, overflow)
+        self.mailbox.name = handle if handle != 'Signal' or signal == -1 else f"Signal:{signal}"
 
+        log.debug("Handler created: %s", self.__dict__)
 
-class HandlerThread(threading.Thread):
-    def __init__(self,
-                 message,
-                 handler,
-                 group=None,
-                 target=None,
-                 name=None,
-                 args=(),
-                 kwargs={}):
-        super(HandlerThread, self).__init__(group=group, target=target, name=name, *args, **kwargs, daemon=True)
-
-        print(f"Handler thread created for {message} : {handler}")
+    def matches(self, event, code=None):
+        """True if messages of event (and signal code) are for this handler, predicate aside"""
+        if self.handle != event and not (self.handle == '*' or fnmatch.fnmatchcase(event or '', self.handle)):
+            return False
+        if code is None or self.signal == -1:
+            return True
+        if isinstance(self.signal, int):
+            return code == self.signal
+        return code in self.signal
 
-        self.message = message
-        self.handler = handler
+    def accepts(self, message):
+        if self.predicate is None:
+            return True
+        try:
+            return bool(self.predicate(message))
+        except Exception as e:
+            log.error("[Handler] Predicate of %s failed: %r", self.mailbox.name, e)
+            return False
 
-    def run(self):
+    def __call__(self, message):
         try:
-            log.debug(f"[HandlerThread] Executing thread for handler: {self.handler.handle}, {self.handler.callback_func}")
-            self.handler.callback_func(self.message, *self.handler.args, **self.handler.kwargs)
-            log.debug(f"[HandlerThread] Executed thread for handler: {self.handler.handle}, {self.handler.callback_func}")            
+            log.debug("[Handler] Executing handler: %s, %s", self.handle, self.callback_func)
+            self.callback_func(message, *self.args, **self.kwargs)
+            log.debug("[Handler] Executed handler: %s, %s", self.handle, self.callback_func)
         except Exception as e:
-            log.error(f"[HandlerThread] Failed to execute: {repr(e)}")
-        return
+            log.error("[Handler] Failed to execute: %r", e)
+
+
+class HandlerRegistry(object):
+    """Handlers by the events they take.
+
+    The handlers an event name (and for Signal, a code) can reach are worked out once and
+    kept until a handler is added or removed, so routing a message is a dict lookup plus
+    the predicates of the handlers found. Readers don't lock: changes replace the handler
+    list and the route table rather than modifying them.
+    """
+    def __init__(self):
+        self._handlers = ()
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handlers)
+
+    def __iter__(self):
+        return iter(self._handlers)
+
+    def __contains__(self, event):
+        """True if any handler may take event"""
+        return bool(self._candidates(event, None))
+
+    def add(self, handler):
+        with self._lock:
+            names = {other.mailbox.name for other in self._handlers}
+            name, n = handler.mailbox.name, 1
+            while handler.mailbox.name in names:
+                n += 1
+                handler.mailbox.name = f"{name}#{n}"
+            self._handlers += (handler,)
+            self._routes = {}
+        return handler
+
+    def remove(self, handler):
+        with self._lock:
+            if handler not in self._handlers:
+                return False
+            self._handlers = tuple(other for other in self._handlers if other is not handler)
+            self._routes = {}
+            return True
+
+    def remove_event(self, event_id):
+        """Remove every handler registered for event_id, returns them"""
+        with self._lock:
+            removed = [handler for handler in self._handlers if handler.handle == event_id]
+            self._handlers = tuple(handler for handler in self._handlers if handler.handle != event_id)
+            self._routes = {}
+            return removed
+
+    def _candidates(self, event, code):
+        routes = self._routes
+        key = (event, code)
+        candidates = routes.get(key)
+        if candidates is None:
+            candidates = routes[key] = tuple(handler for handler in self._handlers if handler.matches(event, code))
+        return candidates
+
+    def route(self, message):
+        """Handlers message goes to"""
+        event = message.get('Event')
+        candidates = self._candidates(event, message.get('Code') if event == 'Signal' else None)
+        return [handler for handler in candidates if handler.accepts(message)]
+
+
+class Mailbox(object):
+    overflow_policies = ('block', 'drop_oldest', 'latest')
+
+    def __init__(self, maxsize=100, overflow='drop_oldest'):
+        if overflow not in self.overflow_policies:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+
+        self.name = None
+        self.maxsize = 1 if overflow == 'latest' else max(1, maxsize)
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+        self.scheduled = False
+
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, message):
+        """Queue message, returns True when the caller has to schedule a drain"""
+        with self._cond:
+            while len(self._items) >= self.maxsize and not self.closed:
+                if self.overflow == 'block':
+                    self._cond.wait()
+                else:
+                    self._items.popleft()
+                    self.dropped += 1
+            if self.closed:
+                return False
+
+            self._items.append((time.perf_counter(), message))
+            if self.scheduled:
+                return False
+            self.scheduled = True
+            return True
+
+    def get(self):
+        """Pop the next (queued_at, message), or None (and unschedule) when empty"""
+        with self._cond:
+            if not self._items or self.closed:
+                self.scheduled = False
+                return None
+            message = self._items.popleft()
+            self._cond.notify()
+            return message
+
+    def keep_scheduled(self):
+        """Called after a drain batch, returns True when more messages are waiting"""
+        with self._cond:
+            if self._items and not self.closed:
+                return True
+            self.scheduled = False
+            return False
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._items.clear()
+            self._cond.notify_all()
+
+
+class Dispatcher(object):
+    """Runs handler callbacks on a fixed pool of worker threads.
+
+    Every handler owns a bounded Mailbox that at most one worker drains at a time, so a
+    handler sees its messages in arrival order while different handlers run in parallel.
+    Workers are daemon threads, started with the first message, so a handler that never
+    returns can't keep the interpreter from exiting.
+    """
+    def __init__(self, workers=4, batch_size=16, shutdown_timeout=5):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.shutdown_timeout = shutdown_timeout
+
+        self._mailboxes = set()
+        self._lock = threading.Lock()
+        self._ready = queue.SimpleQueue()
+        self._threads = []
+        self._local = threading.local()
+        self._shut_down = False
+
+        # Seconds from dispatch to the end of the callback, per handler
+        self.latency = {}
+
+    def _observe(self, name, seconds):
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency.setdefault(name, Histogram())
+        histogram.observe(seconds)
+
+    def dispatch(self, handler, message):
+        if self._shut_down:
+            return
+        mailbox = handler.mailbox
+        with self._lock:
+            self._mailboxes.add(mailbox)
+        if mailbox.put(message):
+            self._submit(handler)
+
+    def _work(self):
+        self._local.worker = True
+        while True:
+            handler = self._ready.get()
+            if handler is None:
+                return
+            self._drain(handler)
+
+    def _drain(self, handler):
+        # Bounded batches keep one busy handler from starving the others in the pool
+        for _ in range(self.batch_size):
+            item = handler.mailbox.get()
+            if item is None:
+                return
+            queued_at, message = item
+            handler(message)
+            self._observe(handler.mailbox.name, time.perf_counter() - queued_at)
+
+        if handler.mailbox.keep_scheduled():
+            self._submit(handler)
+
+    def _submit(self, handler):
+        with self._lock:
+            if self._shut_down:
+                handler.mailbox.close()
+                return
+            if not self._threads:
+                self._threads = [threading.Thread(target=self._work, name=f"VoyagerHandler_{n}", daemon=True)
+                                 for n in range(self.workers)]
+                for thread in self._threads:
+                    thread.start()
+        self._ready.put(handler)
+
+    def queue_depth(self):
+        with self._lock:
+            return sum(len(mailbox) for mailbox in self._mailboxes)
+
+    def queue_depths(self):
+        with self._lock:
+            return {mailbox.name: len(mailbox) for mailbox in self._mailboxes if not mailbox.closed}
+
+    def shutdown(self):
+        """Discard queued messages and wait up to shutdown_timeout seconds for running
+        callbacks to finish
+        """
+        with self._lock:
+            self._shut_down = True
+            mailboxes = list(self._mailboxes)
+            threads = self._threads
+        for mailbox in mailboxes:
+            mailbox.close()
+        for _ in threads:
+            self._ready.put(None)
+
+        # A handler calling close() can't wait on the pool it is running in
+        if getattr(self._local, 'worker', False):
+            return
+        deadline = time.monotonic() + self.shutdown_timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                log.warning("Handler thread %s still busy, not waiting for it", thread.name)
+
+
+def _check_maxlen(maxlen):
+    if maxlen < 1:
+        raise ValueError(f"A RingBuffer holds at least one entry, not {maxlen}")
+
+
+class RingBuffer(object):
+    """Fixed size history that evicts its oldest entry in O(1).
+
+    Every entry gets an increasing sequence number, so readers can fetch what arrived after
+    a cursor without consuming anything. index maps an entry to a key that since() and
+    latest() can filter on; decode is applied to entries as they are read.
+    """
+    def __init__(self, maxlen, index=None, decode=None):
+        _check_maxlen(maxlen)
+        self.maxlen = maxlen
+        self.last_seq = 0
+
+        self._entries = collections.deque(maxlen=maxlen)
+        self._index = index
+        self._by_key = {}
+        self._decode = decode
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter([item for _, item in self.since()])
+
+    def append(self, item):
+        with self._lock:
+            if len(self._entries) == self.maxlen:
+                self._evict()
+
+            self.last_seq += 1
+            entry = (self.last_seq, item)
+            self._entries.append(entry)
+            if self._index:
+                key = self._index(item)
+                keyed = self._by_key.get(key)
+                if keyed is None:
+                    keyed = self._by_key[key] = collections.deque()
+                keyed.append(entry)
+            return self.last_seq
+
+    def _evict(self):
+        _, evicted = self._entries.popleft()
+        if self._index:
+            # The evicted entry is also the oldest one under its key
+            key = self._index(evicted)
+            keyed = self._by_key[key]
+            keyed.popleft()
+            if not keyed:
+                del self._by_key[key]
+
+    def resize(self, maxlen):
+        """Change the capacity, dropping the oldest entries if there are more than maxlen"""
+        _check_maxlen(maxlen)
+        with self._lock:
+            while len(self._entries) > maxlen:
+                self._evict()
+            self._entries = collections.deque(self._entries, maxlen=maxlen)
+            self.maxlen = maxlen
+
+    @property
+    def first_seq(self):
+        return self.last_seq - len(self._entries) + 1
+
+    def keys(self):
+        with self._lock:
+            return list(self._by_key)
+
+    def since(self, cursor=0, key=None, limit=None):
+        """[(seq, item), ...] for entries newer than cursor, oldest first"""
+        with self._lock:
+            if key is None:
+                entries = self._entries
+                # Sequence numbers are contiguous, so the start position is arithmetic
+                start = max(0, cursor - (self.last_seq - len(entries)))
+            else:
+                entries = self._by_key.get(key, ())
+                start = bisect.bisect_right(entries, cursor, key=lambda entry: entry[0])
+            stop = None if limit is None else start + limit
+            selected = list(itertools.islice(entries, start, stop))
+        if self._decode:
+            selected = [(seq, self._decode(item)) for seq, item in selected]
+        return selected
+
+    def next_after(self, cursor):
+        """The single oldest (seq, item) newer than cursor, or None"""
+        entries = self.since(cursor, limit=1)
+        return entries[0] if entries else None
+
+    def latest(self, key=None):
+        with self._lock:
+            entries = self._entries if key is None else self._by_key.get(key)
+            if not entries:
+                return None
+            item = entries[-1][1]
+        return self._decode(item) if self._decode else item
+
+
+class Brief(object):
+    """Defers formatting a log argument, and caps it, until a record is actually emitted"""
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=300):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            if len(value) <= self.limit:
+                return repr(bytes(value))
+            return f"{bytes(value[:self.limit])!r}... ({len(value)} bytes)"
+        text = repr(value)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... ({len(text)} chars)"
+
+
+class Histogram(object):
+    """Cumulative bucket histogram in the Prometheus layout"""
+    default_buckets = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = list(itertools.accumulate(counts))
+        buckets = dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], cumulative))
+        return {'count': count, 'sum': total, 'buckets': buckets}
+
+
+class ClientMetrics(object):
+    """Counters for one client, read with snapshot() or to_prometheus()"""
+    def __init__(self, dispatcher=None):
+        self.events = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.decode_seconds = Histogram()
+
+        self._dispatcher = dispatcher
+
+    def snapshot(self):
+        snapshot = {
+            'events': dict(self.events),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'decode_seconds': self.decode_seconds.snapshot(),
+            'handler_queue_depth': {},
+            'handler_latency_seconds': {}
+        }
+        if self._dispatcher:
+            snapshot['handler_queue_depth'] = self._dispatcher.queue_depths()
+            snapshot['handler_latency_seconds'] = {name: histogram.snapshot()
+                                                   for name, histogram in list(self._dispatcher.latency.items())}
+        return snapshot
+
+    def to_prometheus(self, prefix='voyager'):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        def histogram(name, data, labels=''):
+            for bound, count in data['buckets'].items():
+                lines.append(f'{prefix}_{name}_bucket{{{labels}le="{bound}"}} {count}')
+            braces = f"{{{labels.rstrip(',')}}}" if labels else ''
+            lines.append(f"{prefix}_{name}_sum{braces} {data['sum']}")
+            lines.append(f"{prefix}_{name}_count{braces} {data['count']}")
+
+        metric('events_total', 'counter', 'Messages received by event type')
+        for event, count in sorted(snapshot['events'].items(), key=lambda item: str(item[0])):
+            lines.append(f'{prefix}_events_total{{event="{event}"}} {count}')
+
+        metric('received_bytes_total', 'counter', 'Bytes read from Voyager')
+        lines.append(f"{prefix}_received_bytes_total {snapshot['bytes_in']}")
+        metric('sent_bytes_total', 'counter', 'Bytes written to Voyager')
+        lines.append(f"{prefix}_sent_bytes_total {snapshot['bytes_out']}")
+
+        metric('decode_seconds', 'histogram', 'Time spent parsing a message line')
+        histogram('decode_seconds', snapshot['decode_seconds'])
+
+        metric('handler_queue_depth', 'gauge', 'Messages waiting for a handler')
+        for name, depth in sorted(snapshot['handler_queue_depth'].items()):
+            lines.append(f'{prefix}_handler_queue_depth{{handler="{name}"}} {depth}')
+
+        metric('handler_latency_seconds', 'histogram', 'Time from dispatch until the handler returned')
+        for name, data in sorted(snapshot['handler_latency_seconds'].items()):
+            histogram('handler_latency_seconds', data, f'handler="{name}",')
+
+        return '\n'.join(lines) + '\n'
 
 
 def setup_logging(write_file=False, write_console=True):
@@ -501,11 +2359,15 @@ def setup_logging(write_file=False, write_console=True):
 
 def print_jpg_info(message):
     print("***\n***\n***\n***\n***")
-    raw_image_base64 = message.get('Base64Data')
+    image = message.blob('Base64Data') if isinstance(message, VoyagerMessage) else None
+    raw_image_base64 = message.get('Base64Data') if image is None else None
     message['Base64Data'] = "<stripped>"
     print(message)
-    
-    if raw_image_base64:
+
+    if image is not None:
+        if image.save('image.jpg'):
+            print("New file saved")
+    elif raw_image_base64:
         raw_image_bytes = raw_image_base64.encode('utf-8')
         with open('image.jpg', 'wb') as file_out:
             decoded_image_data = base64.decodebytes(raw_image_bytes)
@@ -0,0 +1,237 @@
+import os
+import json
+import socket
+import struct
+import logging
+import threading
+import collections
+
+from dashboard import diff_state, merge_state
+from ws_transport import LATEST, LOSSLESS, OutboundQueue, encode_frame, encode_image_frame
+
+log = logging.getLogger(__name__)
+
+# Records on the hub socket: kind, length of the JSON meta, length of the payload, then both
+RECORD_HEADER = struct.Struct('>BII')
+
+STATE = 1   # hub -> worker: meta is a dashboard patch, payload its encoded frame
+TOPIC = 2   # hub -> worker: meta is {'topic', 'policy'}, payload the topic's frame
+FETCH = 3   # worker -> hub: meta is {'client', 'request'}
+REPLY = 4   # hub -> worker: meta is {'client'}, payload a frame for that client only
+
+
+class _Link(object):
+    """One end of a hub socket.
+
+    Given an OutboundQueue, records are queued with a policy and key as a client's frames
+    are, and written by the link's own thread, so write() never waits on the other end.
+    Without one, write() sends straight away.
+    """
+    def __init__(self, sock, outbound=None):
+        self.sock = sock
+        self.outbound = outbound
+        self._reader = sock.makefile('rb')
+        self._send_lock = threading.Lock()
+        if outbound is not None:
+            threading.Thread(target=self._write, name='FanoutLinkWriter', daemon=True).start()
+
+    def write(self, kind, meta, payload=b'', policy=LOSSLESS, key=None):
+        """False if the record was dropped"""
+        meta = json.dumps(meta).encode()
+        record = RECORD_HEADER.pack(kind, len(meta), len(payload)) + meta + payload
+        if self.outbound is not None:
+            return self.outbound.put(record, policy, key)
+        with self._send_lock:
+            self.sock.sendall(record)
+        return True
+
+    @property
+    def behind(self):
+        """True once the other end has let more lossless records queue up than allowed"""
+        return self.outbound is not None and self.outbound.over_budget
+
+    def _write(self):
+        while True:
+            record = self.outbound.get()
+            if record is None:
+                return  # Closed
+            try:
+                self.sock.sendall(record)
+            except OSError:
+                # Shutting the socket down ends the reader too, which drops the link
+                self.close()
+                return
+            self.outbound.written += len(record)
+
+    def read(self):
+        """(kind, meta, payload), or None once the other end has gone"""
+        header = self._reader.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        kind, meta_length, payload_length = RECORD_HEADER.unpack(header)
+        meta = json.loads(self._reader.read(meta_length))
+        return kind, meta, self._reader.read(payload_length)
+
+    def close(self):
+        if self.outbound is not None:
+            self.outbound.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class _Replies(object):
+    """Looks enough like a BridgeServer for a fetch handler to answer a worker's client"""
+    def __init__(self, link):
+        self.link = link
+
+    def send_message(self, client, msg):
+        self.link.write(REPLY, {'client': client['id']}, encode_frame(msg))
+
+    def send_image(self, client, header, image, *args, **kwargs):
+        self.link.write(REPLY, {'client': client['id']}, encode_image_frame(header, image))
+
+
+class FanoutHub(object):
+    """Voyager side of the fan-out tier.
+
+    Stands in for the DashboardBroadcaster and TopicCache of a single process bridge:
+    update() and publish() encode every change once and pass the frames on to each worker
+    process over a Unix socket, and a worker that connects late is sent the current state
+    and topics first. Requests the workers' clients make of the hub, such as image
+    fetches, go to on_fetch.
+
+    Each worker has its own bounded queue and writer thread, with topic frames queued
+    under their policy, so a stalled worker never holds up the others or the Voyager
+    handler broadcasting. A worker over max_queue_bytes or max_queue_frames is
+    disconnected.
+    """
+    def __init__(self, path, on_fetch=None, max_queue_bytes=32 * 1024 * 1024, max_queue_frames=1000):
+        self.path = path
+        self.on_fetch = on_fetch
+        self.max_queue_bytes = max_queue_bytes
+        self.max_queue_frames = max_queue_frames
+        self.state = {}
+
+        self._topics = collections.OrderedDict()
+        self._links = []
+        self._lock = threading.RLock()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen()
+        threading.Thread(target=self._accept, name='FanoutHub', daemon=True).start()
+
+    def update(self, datastruct):
+        with self._lock:
+            patch = diff_state(self.state, datastruct)
+            if not patch:
+                return
+            merge_state(self.state, patch)
+            self._broadcast(STATE, patch, encode_frame(json.dumps(patch)))
+
+    def publish(self, topic, frame, policy=LATEST):
+        with self._lock:
+            self._topics[topic] = (frame, policy)
+            self._broadcast(TOPIC, {'topic': topic, 'policy': policy}, frame, policy, topic)
+
+    @property
+    def workers(self):
+        return len(self._links)
+
+    def _broadcast(self, kind, meta, payload, policy=LOSSLESS, key=None):
+        for link in list(self._links):
+            link.write(kind, meta, payload, policy, key)
+            if link.behind:
+                log.warning("Dropping a fan-out worker that fell behind: %s", link.outbound.stats())
+                self._drop(link)
+
+    def _drop(self, link):
+        with self._lock:
+            if link in self._links:
+                self._links.remove(link)
+        link.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            link = _Link(conn, OutboundQueue(self.max_queue_bytes, self.max_queue_frames))
+            with self._lock:
+                if self.state:
+                    link.write(STATE, self.state, encode_frame(json.dumps(self.state)))
+                for topic, (frame, policy) in self._topics.items():
+                    link.write(TOPIC, {'topic': topic, 'policy': policy}, frame, policy, topic)
+                self._links.append(link)
+            log.info("Fan-out worker connected, %d in total", len(self._links))
+            threading.Thread(target=self._serve, args=(link,), name='FanoutHubWorker', daemon=True).start()
+
+    def _serve(self, link):
+        replies = _Replies(link)
+        try:
+            while True:
+                record = link.read()
+                if record is None:
+                    break
+                kind, meta, _ = record
+                if kind == FETCH and self.on_fetch:
+                    self.on_fetch({'id': meta['client']}, replies, meta['request'])
+        except OSError:
+            pass
+        self._drop(link)
+
+    def close(self):
+        self._sock.close()
+        for link in list(self._links):
+            self._drop(link)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class HubLink(object):
+    """Worker side of the fan-out tier: feeds a worker's own DashboardBroadcaster and
+    TopicCache from the hub, so per-client rates, snapshots and late joiners are handled
+    in the worker without the hub knowing about its clients.
+    """
+    def __init__(self, path, server, dashboard, topics):
+        self.server = server
+        self.dashboard = dashboard
+        self.topics = topics
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self._link = _Link(sock)
+        self.closed = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='HubLink', daemon=True).start()
+
+    def fetch(self, client, server, request):
+        """Pass a client's request on to the hub, which has the images and history"""
+        self._link.write(FETCH, {'client': client['id'], 'request': request})
+
+    def _run(self):
+        try:
+            while True:
+                record = self._link.read()
+                if record is None:
+                    break
+                kind, meta, payload = record
+                if kind == STATE:
+                    self.dashboard.apply(meta, payload)
+                elif kind == TOPIC:
+                    self.topics.publish(meta['topic'], payload, meta['policy'])
+                elif kind == REPLY:
+                    for client in list(self.server.clients):
+                        if client['id'] == meta['client']:
+                            self.server.send_frame(client, payload)
+        except OSError:
+            pass
+        log.warning("Lost the fan-out hub")
+        self.closed.set()
@@ -1,21 +1,25 @@
 import os
-import io
 import json
-import base64
+import math
+import time
 import logging
-
-from PIL import Image
-
+import socket
+import argparse
+import functools
+import tempfile
+import multiprocessing
+
+from analytics import QualityMonitor
+from capture import CaptureWriter
+from dashboard import DashboardBroadcaster, TopicCache
+from telemetry import TelemetryStore
+from thumbnails import ThumbnailPipeline
+from ws_fanout import FanoutHub, HubLink
 from voyager_api import VoyagerClient, setup_logging
-from websocket_server import WebsocketServer
+from ws_transport import DROPPABLE, BridgeServer, encode_frame, encode_image_frame
 
 log = logging.getLogger(__name__)
 
-setup_logging(True, False)
-
-vclient = VoyagerClient('172.16.50.50', 5950)
-vclient.start()
-
 
 def _map_ccdstat(val):
     return {
@@ -53,8 +57,9 @@ def _map_guidestat(val):
 
 
 def handle_control_data(message, *args, **kwargs):
-    ws_server = kwargs.get('server')
-    if not ws_server:
+    dashboard = kwargs.get('dashboard')
+    analytics = kwargs.get('analytics')
+    if not dashboard:
         return
 
     datastruct = {
@@ -105,27 +110,15 @@ def handle_control_data(message, *args, **kwargs):
 
     }
 
-    ws_server.send_message_to_all(json.dumps(datastruct))
-
+    if analytics:
+        guiding = analytics.guiding()
+        datastruct['guider'].update(rms_ra=guiding['ra'], rms_dec=guiding['dec'], rms=guiding['rms'])
 
-def _resize_jpg_image(jpeg_base64, x_orig_size, y_orig_size, scale_factor):
-    buffer = io.BytesIO()
-    imgdata = base64.b64decode(jpeg_base64)
-    img = Image.open(io.BytesIO(imgdata))
-    new_img = img.resize((int(x_orig_size / scale_factor), int(y_orig_size / scale_factor)))
-    new_img.save(buffer, format="JPEG")
-    img_b64 = base64.b64encode(buffer.getvalue())
-    return str(img_b64)[2:-1]
+    dashboard.update(datastruct)
 
 
-def handle_new_jpg(message, *args, **kwargs):
-    ws_server = kwargs.get('server')
-    if not ws_server:
-        return
-
-    scale_factor = 18
-
-    datastruct = {
+def _jpgshot_header(message, size, thumbnail_size):
+    return {
         'jpgshot': {
             'file': message['File'],
             'target': message['SequenceTarget'],
@@ -135,16 +128,147 @@ def handle_new_jpg(message, *args, **kwargs):
             'filter': message['Filter'],
             'hfd': message['HFD'],
             'starindex': message['StarIndex'],
-            'x_size': int(message['PixelDimX'] / scale_factor),
-            'y_size': int(message['PixelDimY'] / scale_factor),
-            'base64data': _resize_jpg_image(message['Base64Data'],
-                                            message['PixelDimX'],
-                                            message['PixelDimY'],
-                                            scale_factor)
+            'x_size': thumbnail_size[0],
+            'y_size': thumbnail_size[1],
+            'size': size
         }
     }
 
-    ws_server.send_message_to_all(json.dumps(datastruct))
+
+def handle_new_jpg(message, *args, **kwargs):
+    topics = kwargs.get('topics')
+    pipeline = kwargs.get('thumbnails')
+    analytics = kwargs.get('analytics')
+    if not topics or not pipeline:
+        return
+
+    if analytics:
+        focus = analytics.focus(message['SequenceTarget'], message['Filter'])
+        if focus:
+            topics.publish('focus', encode_frame(json.dumps({'focus': focus})))
+
+    def on_thumbnails(future):
+        if future.exception():
+            return
+        thumbnail, thumbnail_size = future.result()['thumb']
+        frame = encode_image_frame(_jpgshot_header(message, 'thumb', thumbnail_size), thumbnail)
+        topics.publish('image', frame, DROPPABLE)
+
+    # Decoding happens in the pool, the handler thread is free again straight away
+    future = pipeline.submit(message)
+    if future is not None:
+        future.add_done_callback(on_thumbnails)
+
+
+def handle_fetch(client, server, request, thumbnails):
+    """Send one client another size of a recent frame: a preset name or 'full'"""
+    file = request.get('file')
+    size = request.get('fetch')
+    if size == 'full':
+        image = thumbnails.original(file)
+        header = {'fullres': {'file': file, 'size': size}}
+    else:
+        image, (x_size, y_size) = (thumbnails.get(file) or {}).get(size, (None, (None, None)))
+        header = {'fullres': {'file': file, 'size': size, 'x_size': x_size, 'y_size': y_size}}
+
+    if image is None:
+        server.send_message(client, json.dumps({'error': {'fetch': size, 'file': file, 'reason': 'not available'}}))
+        return
+    server.send_image(client, header, image)
+
+
+def _json_values(values):
+    return [None if value != value else round(value, 4) for value in values.tolist()]
+
+
+def _request_number(request, key, default):
+    """Finite number a client sent as key, default if it sent none"""
+    value = request.get(key)
+    if value is None:
+        return default
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} is not a number")
+    if not math.isfinite(number):
+        raise ValueError(f"{key} is not a number")
+    return number
+
+
+def _send_error(client, server, request_kind, reason):
+    server.send_message(client, json.dumps({'error': {request_kind: True, 'reason': reason}}))
+
+
+def handle_history(client, server, request, store):
+    """Send one client a downsampled chart of telemetry fields, the last hour by default"""
+    requested = request.get('history')
+    try:
+        if not isinstance(requested, list):
+            raise ValueError("history is not a list of fields")
+        end = _request_number(request, 'end', None) or time.time()
+        start = _request_number(request, 'start', None) or end - 3600
+        points = min(max(int(_request_number(request, 'points', 300)), 1), 2000)
+        if start >= end:
+            raise ValueError("start is not before end")
+    except ValueError as e:
+        _send_error(client, server, 'history', str(e))
+        return
+
+    fields = [field for field in requested if isinstance(field, str) and field in store.fields]
+    result = store.query(fields, start, end, points)
+
+    datastruct = {
+        'history': {
+            't': _json_values(result['t']),
+            'fields': {field: {key: _json_values(result[field][key]) for key in ('min', 'max', 'mean')}
+                       for field in fields}
+        }
+    }
+    server.send_message(client, json.dumps(datastruct))
+
+
+def handle_analytics(client, server, request, analytics):
+    """Send one client the guiding RMS and the focus trend of every target and filter"""
+    try:
+        window = _request_number(request, 'window', None)
+    except ValueError as e:
+        _send_error(client, server, 'analytics', str(e))
+        return
+
+    summary = analytics.summary()
+    if window is not None and window > 0:
+        # Kept between a second and a day, anything else gets the monitor's own window
+        summary['guiding'] = analytics.guiding(min(max(window, 1), 86400))
+    server.send_message(client, json.dumps({'analytics': summary}))
+
+
+def handle_hub_request(client, server, request, thumbnails, store=None, analytics=None):
+    """Requests the fan-out workers pass on to the hub"""
+    if 'fetch' in request:
+        handle_fetch(client, server, request, thumbnails)
+    elif 'history' in request and store is not None:
+        handle_history(client, server, request, store)
+    elif 'analytics' in request and analytics:
+        handle_analytics(client, server, request, analytics)
+
+
+def message_received(client, server, message, fetch=None, dashboard=None, history=None, analytics=None):
+    try:
+        request = json.loads(message)
+    except ValueError:
+        log.warning("Client(%d) sent something that isn't JSON: %.100s", client['id'], message)
+        return
+
+    if 'fetch' in request and fetch:
+        fetch(client, server, request)
+    if 'history' in request and history:
+        history(client, server, request)
+    if 'analytics' in request and analytics:
+        analytics(client, server, request)
+    if 'rate' in request and dashboard:
+        dashboard.set_rate(client, float(request['rate'] or 0))
+    if request.get('snapshot') and dashboard:
+        dashboard.send_snapshot(client)
 
 
 def _map_shotstat(val):
@@ -158,8 +282,8 @@ def _map_shotstat(val):
 
 
 def handle_shot_running(message, *args, **kwargs):
-    ws_server = kwargs.get('server')
-    if not ws_server:
+    topics = kwargs.get('topics')
+    if not topics:
         return
 
     datastruct = {
@@ -172,24 +296,151 @@ def handle_shot_running(message, *args, **kwargs):
         }
     }
 
-    ws_server.send_message_to_all(json.dumps(datastruct))
-
+    topics.publish('shot', encode_frame(json.dumps(datastruct)))
 
-vclient.cmd.set_dashboard('enable')
 
-def new_client(client, server):
+def new_client(client, server, dashboard=None, topics=None):
     log.info("New client connected and was given id %d" % client['id'])
+    # Everything known so far, so the dashboard is complete before the next event
+    if dashboard:
+        dashboard.send_snapshot(client)
+    if topics:
+        topics.replay(client)
 
 
-def client_left(client, server):
+def client_left(client, server, dashboard=None):
+    # The server calls this for connections that never finished the handshake too
+    if not client:
+        return
     log.info("Client(%d) disconnected" % client['id'])
-
-PORT=9001
-server = WebsocketServer(port=PORT)
-server.set_fn_new_client(new_client)
-
-vclient.add_handler('ControlData', handle_control_data, server=server)
-vclient.add_handler('NewJPGReady', handle_new_jpg, server=server)
-vclient.add_handler('ShotRunning', handle_shot_running, server=server)
-
-server.run_forever()
+    if dashboard:
+        dashboard.forget(client)
+
+
+def _connect_voyager(voyager_host, voyager_port, record=None, observers=()):
+    """observers are attached to the client before it starts, so they see every event"""
+    vclient = VoyagerClient(voyager_host, voyager_port)
+    if record:
+        vclient.recorder = CaptureWriter(record)
+    for observer in observers:
+        observer.attach(vclient)
+    vclient.start()
+
+    vclient.cmd.set_dashboard('enable')
+    return vclient
+
+
+def _add_handlers(vclient, dashboard, topics, thumbnails, analytics):
+    vclient.add_handler('ControlData', handle_control_data, dashboard=dashboard, analytics=analytics)
+    vclient.add_handler('NewJPGReady', handle_new_jpg, topics=topics, thumbnails=thumbnails, analytics=analytics)
+    vclient.add_handler('ShotRunning', handle_shot_running, topics=topics)
+
+
+def start_bridge(voyager_host='172.16.50.50', voyager_port=5950, ws_host='127.0.0.1', ws_port=9001, record=None,
+                 telemetry=None, **server_options):
+    """telemetry is a TelemetryStore to record into and answer history requests from,
+    server_options go to BridgeServer, e.g. batch_window or compression
+    """
+    analytics = QualityMonitor()
+    observers = [analytics] if telemetry is None else [analytics, telemetry]
+    vclient = _connect_voyager(voyager_host, voyager_port, record, observers)
+
+    server = BridgeServer(host=ws_host, port=ws_port, **server_options)
+    dashboard = DashboardBroadcaster(server)
+    topics = TopicCache(server)
+    server.set_fn_new_client(functools.partial(new_client, dashboard=dashboard, topics=topics))
+    server.set_fn_client_left(functools.partial(client_left, dashboard=dashboard))
+
+    thumbnails = ThumbnailPipeline()
+    thumbnails.start()
+    history = functools.partial(handle_history, store=telemetry) if telemetry is not None else None
+    server.set_fn_message_received(functools.partial(message_received, dashboard=dashboard, history=history,
+                                                     fetch=functools.partial(handle_fetch, thumbnails=thumbnails),
+                                                     analytics=functools.partial(handle_analytics, analytics=analytics)))
+
+    _add_handlers(vclient, dashboard, topics, thumbnails, analytics)
+
+    return vclient, server
+
+
+def run_worker(hub_path, ws_host, ws_port, server_options=None):
+    """Body of a fan-out worker process: serves websocket clients from what the hub sends"""
+    server = BridgeServer(host=ws_host, port=ws_port, reuse_port=True, **(server_options or {}))
+    dashboard = DashboardBroadcaster(server)
+    topics = TopicCache(server)
+    hub = HubLink(hub_path, server, dashboard, topics)
+    server.set_fn_new_client(functools.partial(new_client, dashboard=dashboard, topics=topics))
+    server.set_fn_client_left(functools.partial(client_left, dashboard=dashboard))
+    server.set_fn_message_received(functools.partial(message_received, dashboard=dashboard, fetch=hub.fetch,
+                                                     history=hub.fetch, analytics=hub.fetch))
+
+    hub.start()
+    server.run_forever(threaded=True)
+    hub.closed.wait()
+    server.shutdown_gracefully()
+
+
+def start_fanout(voyager_host='172.16.50.50', voyager_port=5950, ws_host='127.0.0.1', ws_port=9001, workers=4,
+                 hub_path=None, record=None, telemetry=None, **server_options):
+    """Bridge for many viewers: this process holds the Voyager connection and encodes each
+    update once, and worker processes share ws_port to serve the websocket clients.
+
+    Returns (vclient, hub, worker processes, ws_port).
+    """
+    hub_path = hub_path or os.path.join(tempfile.gettempdir(), f"voyager-bridge-{os.getpid()}.sock")
+    if not ws_port:
+        # Every worker has to bind the same port, so pick one for them
+        with socket.socket() as sock:
+            sock.bind((ws_host, 0))
+            ws_port = sock.getsockname()[1]
+
+    analytics = QualityMonitor()
+    observers = [analytics] if telemetry is None else [analytics, telemetry]
+    vclient = _connect_voyager(voyager_host, voyager_port, record, observers)
+    thumbnails = ThumbnailPipeline()
+    thumbnails.start()
+    hub = FanoutHub(hub_path, on_fetch=functools.partial(handle_hub_request, thumbnails=thumbnails, store=telemetry,
+                                                         analytics=analytics))
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(hub_path, ws_host, ws_port, server_options), daemon=True,
+                                 name=f"BridgeWorker-{n}")
+                 for n in range(workers)]
+    for process in processes:
+        process.start()
+
+    _add_handlers(vclient, hub, hub, thumbnails, analytics)
+
+    return vclient, hub, processes, ws_port
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--voyager-host", default='172.16.50.50')
+    parser.add_argument("--voyager-port", type=int, default=5950)
+    parser.add_argument("-p", "--port", type=int, default=9001)
+    parser.add_argument("--record", default=None, help="Capture the Voyager session to this file")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="Serve websocket clients from this many worker processes")
+    parser.add_argument("--telemetry", default=None, help="Keep ControlData history in this directory")
+    parser.add_argument("--batch-ms", type=float, default=0,
+                        help="Merge messages produced within this many milliseconds into one frame")
+    parser.add_argument("--no-compression", action="store_true", default=False,
+                        help="Don't accept permessage-deflate from clients")
+
+    args = parser.parse_args()
+
+    setup_logging(True, False)
+
+    server_options = {'batch_window': args.batch_ms / 1000, 'compression': not args.no_compression}
+    telemetry = TelemetryStore(args.telemetry) if args.telemetry else None
+    if args.workers:
+        vclient, hub, processes, _ = start_fanout(args.voyager_host, args.voyager_port, ws_port=args.port,
+                                                  workers=args.workers, record=args.record, telemetry=telemetry,
+                                                  **server_options)
+        for process in processes:
+            process.join()
+    else:
+        vclient, server = start_bridge(args.voyager_host, args.voyager_port, ws_port=args.port, record=args.record,
+                                       telemetry=telemetry, **server_options)
+        server.run_forever()
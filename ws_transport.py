@@ -0,0 +1,392 @@
+import json
+import time
+import zlib
+import socket
+import struct
+import logging
+import threading
+import collections
+
+from websocket_server import WebsocketServer, WebSocketHandler
+from websocket_server.websocket_server import (FIN, OPCODE, MASKED, PAYLOAD_LEN, PAYLOAD_LEN_EXT16, PAYLOAD_LEN_EXT64,
+                                               OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE_CONN, OPCODE_PING,
+                                               OPCODE_PONG)
+
+log = logging.getLogger(__name__)
+
+IMAGE_HEADER_LENGTH = struct.Struct('>I')
+
+RSV1 = 0x40  # Set on messages compressed with permessage-deflate
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+# Outbound queue policies
+LATEST = 'latest'
+DROPPABLE = 'droppable'
+LOSSLESS = 'lossless'
+
+
+def encode_frame(payload, opcode=OPCODE_TEXT, rsv=0):
+    """A complete, unmasked websocket frame, ready to be written to any number of clients"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    length = len(payload)
+    if length <= 125:
+        header = struct.pack('>BB', FIN | rsv | opcode, length)
+    elif length <= 65535:
+        header = struct.pack('>BBH', FIN | rsv | opcode, PAYLOAD_LEN_EXT16, length)
+    else:
+        header = struct.pack('>BBQ', FIN | rsv | opcode, PAYLOAD_LEN_EXT64, length)
+    return header + payload
+
+
+def decode_frame(frame):
+    """(opcode, payload) of a frame made by encode_frame"""
+    length = frame[1] & PAYLOAD_LEN
+    start = 2 if length < PAYLOAD_LEN_EXT16 else 4 if length == PAYLOAD_LEN_EXT16 else 10
+    return frame[0] & OPCODE, memoryview(frame)[start:]
+
+
+def unmask(payload, mask):
+    """XOR a client's payload with its mask as one big integer, not byte by byte"""
+    length = len(payload)
+    if not length:
+        return payload
+    mask = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(length, 'big')
+
+
+def negotiate_deflate(offers):
+    """(response, server window bits, server_no_context_takeover) for the first usable
+    permessage-deflate offer in a Sec-WebSocket-Extensions header, or None
+    """
+    for offer in offers.split(','):
+        name, *params = [part.strip() for part in offer.split(';')]
+        if name != 'permessage-deflate':
+            continue
+        params = dict((param.split('=', 1) + [None])[:2] for param in params if param)
+        response = ['permessage-deflate']
+        bits = 15
+        if 'server_max_window_bits' in params:
+            bits = int(params['server_max_window_bits'].strip('"'))
+            if bits < 9:
+                continue  # zlib can't make a raw deflate stream with a smaller window
+            response.append(f"server_max_window_bits={bits}")
+        no_context_takeover = 'server_no_context_takeover' in params
+        if no_context_takeover:
+            response.append('server_no_context_takeover')
+        return '; '.join(response), bits, no_context_takeover
+    return None
+
+
+def encode_image_frame(header, image):
+    """Binary frame of an image: a 4 byte big endian length, that many bytes of JSON
+    header, then the image file itself. Browsers read it with a DataView and a Blob slice.
+    """
+    header = json.dumps(header).encode()
+    return encode_frame(IMAGE_HEADER_LENGTH.pack(len(header)) + header + image, OPCODE_BINARY)
+
+
+def decode_image_frame(payload):
+    """(header, image bytes) of a binary image frame's payload"""
+    header_length, = IMAGE_HEADER_LENGTH.unpack_from(payload)
+    end = IMAGE_HEADER_LENGTH.size + header_length
+    return json.loads(payload[IMAGE_HEADER_LENGTH.size:end]), payload[end:]
+
+
+class OutboundQueue(object):
+    """Bounded queue of frames waiting for one client's writer thread.
+
+    LATEST frames replace a queued frame with the same key, for state where only the
+    newest value matters. DROPPABLE frames do the same, and are discarded rather than
+    queued once the client is over max_bytes. LOSSLESS frames are always queued, and
+    one that takes the client over max_bytes or max_frames marks it as over budget.
+    """
+    def __init__(self, max_bytes=8 * 1024 * 1024, max_frames=1000):
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+
+        self.bytes = 0
+        self.sent = 0
+        self.written = 0
+        self.dropped = 0
+        self.replaced = 0
+        self.over_budget = False
+        self.closed = False
+
+        self._entries = collections.deque()
+        self._keyed = {}
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def has_pending(self, key):
+        return key in self._keyed
+
+    def put(self, frame, policy=LOSSLESS, key=None):
+        """False if the frame was dropped"""
+        with self._cond:
+            if self.closed:
+                return False
+
+            entry = self._keyed.get(key) if key is not None and policy != LOSSLESS else None
+            if entry is not None:
+                self.bytes += len(frame) - len(entry[1])
+                entry[1] = frame
+                self.replaced += 1
+                return True
+
+            if policy == DROPPABLE and self.bytes + len(frame) > self.max_bytes:
+                self.dropped += 1
+                return False
+
+            entry = [key, frame]
+            self._entries.append(entry)
+            if key is not None and policy != LOSSLESS:
+                self._keyed[key] = entry
+            self.bytes += len(frame)
+            if policy == LOSSLESS and (self.bytes > self.max_bytes or len(self._entries) > self.max_frames):
+                self.over_budget = True
+            self._cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Next frame, waiting up to timeout seconds for one, or None"""
+        with self._cond:
+            if not self._entries and not self.closed:
+                self._cond.wait_for(lambda: self._entries or self.closed, timeout)
+            if self.closed or not self._entries:
+                return None
+            entry = self._entries.popleft()
+            key, frame = entry
+            if key is not None and self._keyed.get(key) is entry:
+                del self._keyed[key]
+            self.bytes -= len(frame)
+            self.sent += 1
+            return frame
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._entries.clear()
+            self._keyed.clear()
+            self.bytes = 0
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'frames': len(self._entries),
+            'bytes': self.bytes,
+            'sent': self.sent,
+            'written': self.written,
+            'dropped': self.dropped,
+            'replaced': self.replaced
+        }
+
+
+class BridgeHandler(WebSocketHandler):
+    """Frames are queued per client and written by the client's own writer thread, so a
+    slow reader only ever holds itself up. A client over its queue budget, or one that
+    takes no data at all for send_timeout seconds, is disconnected.
+
+    Clients that offer permessage-deflate get their text messages compressed with a
+    context kept across messages. With the server's batch_window set, the writer waits
+    that long after a frame for more, merges the text messages among them into one JSON
+    array message, and writes the lot with a single send.
+    """
+    max_batch = 64
+
+    def setup(self):
+        super(BridgeHandler, self).setup()
+        self.deflater = None
+        self.inflater = None
+        self._deflate_bits = 15
+        self._no_context_takeover = False
+        self.outbound = OutboundQueue(self.server.max_queue_bytes, self.server.max_queue_frames)
+        threading.Thread(target=self._write, name='BridgeWriter', daemon=True).start()
+
+    def handshake(self):
+        headers = self.read_http_headers()
+        if headers.get('upgrade', '').lower() != 'websocket':
+            self.keep_alive = False
+            return
+        key = headers.get('sec-websocket-key')
+        if not key:
+            log.warning("Client tried to connect but was missing a key")
+            self.keep_alive = False
+            return
+
+        response = self.make_handshake_response(key)
+        deflate = negotiate_deflate(headers.get('sec-websocket-extensions', '')) if self.server.compression else None
+        if deflate:
+            extension, self._deflate_bits, self._no_context_takeover = deflate
+            self.deflater = self._new_deflater()
+            self.inflater = zlib.decompressobj(-15)
+            response = response[:-2] + f"Sec-WebSocket-Extensions: {extension}\r\n\r\n"
+
+        with self._send_lock:
+            self.handshake_done = self.request.send(response.encode())
+        self.valid_client = True
+        self.server._new_client_(self)
+
+    def _new_deflater(self):
+        return zlib.compressobj(self.server.compression_level, zlib.DEFLATED, -self._deflate_bits)
+
+    def read_next_message(self):
+        try:
+            header = self.read_bytes(2)
+        except OSError:
+            header = b''
+        if len(header) < 2:
+            self.keep_alive = False
+            return
+
+        first, second = header
+        opcode = first & OPCODE
+        if opcode == OPCODE_CLOSE_CONN:
+            log.info("Client asked to close connection.")
+            self.keep_alive = False
+            return
+        if not second & MASKED:
+            log.warning("Client must always be masked.")
+            self.keep_alive = False
+            return
+
+        length = second & PAYLOAD_LEN
+        if length == PAYLOAD_LEN_EXT16:
+            length = struct.unpack('>H', self.read_bytes(2))[0]
+        elif length == PAYLOAD_LEN_EXT64:
+            length = struct.unpack('>Q', self.read_bytes(8))[0]
+        mask = self.read_bytes(4)
+        payload = unmask(self.read_bytes(length), mask)
+
+        if opcode == OPCODE_TEXT:
+            if first & RSV1 and self.inflater:
+                payload = self.inflater.decompress(payload + DEFLATE_TAIL)
+            self.server._message_received_(self, payload.decode('utf8'))
+        elif opcode == OPCODE_PING:
+            self.server._ping_received_(self, payload)
+        elif opcode == OPCODE_PONG:
+            self.server._pong_received_(self, payload)
+        else:
+            log.warning("Ignoring frame with opcode %#x from client", opcode)
+
+    def _write(self):
+        # A send timeout only, a socket timeout would also drop clients that are quiet
+        seconds = int(self.server.send_timeout)
+        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                                struct.pack('ll', seconds, int((self.server.send_timeout - seconds) * 1e6)))
+        window = self.server.batch_window
+        while True:
+            frames = [self.outbound.get()]
+            if frames[0] is None:
+                return
+            if window:
+                deadline = time.monotonic() + window
+                while len(frames) < self.max_batch:
+                    frame = self.outbound.get(deadline - time.monotonic())
+                    if frame is None:
+                        break
+                    frames.append(frame)
+
+            data = self._prepare(frames)
+            try:
+                with self._send_lock:
+                    self.request.sendall(data)
+            except OSError as e:
+                self.disconnect(f"send failed: {e!r}")
+                return
+            self.outbound.written += len(data)
+
+    def _prepare(self, frames):
+        if not self.deflater and len(frames) == 1:
+            return frames[0]
+
+        prepared = []
+        texts = []
+        for frame in frames:
+            opcode, payload = decode_frame(frame)
+            if opcode == OPCODE_TEXT:
+                texts.append(payload)
+                continue
+            if texts:
+                prepared.append(self._text_frame(texts))
+                texts = []
+            prepared.append(frame)
+        if texts:
+            prepared.append(self._text_frame(texts))
+        return b''.join(prepared)
+
+    def _text_frame(self, texts):
+        payload = texts[0] if len(texts) == 1 else b'[' + b','.join(texts) + b']'
+        if not self.deflater:
+            return encode_frame(payload)
+        if self._no_context_takeover:
+            self.deflater = self._new_deflater()
+        compressed = self.deflater.compress(payload) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        return encode_frame(compressed[:-len(DEFLATE_TAIL)], OPCODE_TEXT, RSV1)
+
+    def send_frame(self, frame, policy=LOSSLESS, key=None):
+        sent = self.outbound.put(frame, policy, key)
+        if self.outbound.over_budget:
+            self.disconnect(f"over its queue budget with {len(self.outbound)} frames, {self.outbound.bytes} bytes")
+        return sent
+
+    def send_text(self, message, opcode=OPCODE_TEXT):
+        self.send_frame(encode_frame(message, opcode))
+
+    def disconnect(self, reason):
+        if self.outbound.closed:
+            return
+        log.warning("Disconnecting slow client %s: %s", self.client_address, reason)
+        self.outbound.close()
+        self.keep_alive = False
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def finish(self):
+        self.outbound.close()
+        super(BridgeHandler, self).finish()
+
+
+class BridgeServer(WebsocketServer):
+    """WebsocketServer that can send binary frames, encodes each broadcast only once, and
+    gives every client its own bounded outbound queue (see OutboundQueue for the policies).
+    """
+    def __init__(self, *args, max_queue_bytes=8 * 1024 * 1024, max_queue_frames=1000, send_timeout=10,
+                 reuse_port=False, compression=True, compression_level=6, batch_window=0.0, **kwargs):
+        # Lets several worker processes listen on the same port, the kernel spreads connections over them
+        self.allow_reuse_port = reuse_port
+        super(BridgeServer, self).__init__(*args, **kwargs)
+        self.RequestHandlerClass = BridgeHandler
+        self.max_queue_bytes = max_queue_bytes
+        self.max_queue_frames = max_queue_frames
+        self.send_timeout = send_timeout
+        self.compression = compression
+        self.compression_level = compression_level
+        self.batch_window = batch_window
+
+    def send_frame(self, client, frame, policy=LOSSLESS, key=None):
+        return client['handler'].send_frame(frame, policy, key)
+
+    def send_frame_to_all(self, frame, policy=LOSSLESS, key=None):
+        for client in list(self.clients):
+            self.send_frame(client, frame, policy, key)
+
+    def has_pending(self, client, key):
+        return client['handler'].outbound.has_pending(key)
+
+    def send_message_to_all(self, msg, policy=LOSSLESS, key=None):
+        self.send_frame_to_all(encode_frame(msg), policy, key)
+
+    def send_image(self, client, header, image, policy=LOSSLESS, key=None):
+        self.send_frame(client, encode_image_frame(header, image), policy, key)
+
+    def send_image_to_all(self, header, image, policy=DROPPABLE, key='image'):
+        self.send_frame_to_all(encode_image_frame(header, image), policy, key)
+
+    def queue_stats(self):
+        """Outbound queue of every client, by client id"""
+        return {client['id']: client['handler'].outbound.stats() for client in list(self.clients)}